@@ -0,0 +1,190 @@
+"""
+Compare building the TRUSTS payload of a broker description from the slotted
+``etl.ckan`` records with the implementation they replaced, which started
+every CKAN package from a ``deepcopy`` of a template dict and filled it in
+key by key.
+
+    python benchmarks/bench_ckan_records.py [n_representations ...]
+"""
+import os
+import sys
+import timeit
+
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'interoperability'))
+
+from clone_experiment import (GraphIndex, ckan_result_to_client_json,
+                              clean_multilang, graphs_to_ckan_package,
+                              package_to_client_json)
+from fixtures import make_description
+
+
+empty_result = {
+    "author": None,
+    "author_email": None,
+    "creator_user_id": "__MISSING__",
+    "id": "__MISSING__",
+    "isopen": None,
+    "license_id": "__MISSING__",
+    "license_title": "__MISSING__",
+    "license_url": "__MISSING__",
+    "maintainer": None,
+    "maintainer_email": None,
+    "metadata_created": "__MISSING__",
+    "metadata_modified": "__MISSING__",
+    "name": "__MISSING__",
+    "notes": None,
+    "num_resources": 0,
+    "num_tags": 0,
+    "owner_org": "__MISSING__",
+    "private": None,
+    "state": "active",
+    "theme": "__MISSING__",
+    "title": "__MISSING__",
+    "type": "__MISSING__",
+    "url": None,
+    "version": "__MISSING__",
+    "tags": [],
+    "groups": [],
+    "dataset_count": 0,
+    "service_count": 0,
+    "application_count": 0,
+    "relationships_as_object": [],
+    "relationships_as_subject": [],
+    "resources": [],
+    "organization": {}
+}
+
+
+def deepcopy_ckan_result_format(raw_jsonld, index):
+    """
+    ``graphs_to_ckan_result_format`` as it was before the slotted records,
+    with the debugging leftovers removed.
+    """
+    resource_graphs = index.of_type("ids:Resource")
+    if "theme" not in resource_graphs[0].keys():
+        return None
+    representation_graphs = index.of_type("ids:Representation")
+    artifact_graphs = index.of_type("ids:Artifact")
+
+    resource_uri = resource_graphs[0]["sameAs"]
+
+    theirname = resource_uri
+    organization_name = theirname.split("/")[2].split(":")[0]
+    providing_base_url = "/".join(organization_name.split("/")[:3])
+    organization_data = {
+        "id": "52bc9332-2ba1-4c4f-bf85-5a141cd68423",
+        "name": organization_name,
+        "title": "Orga1",
+        "type": "organization",
+        "description": "",
+        "image_url": "",
+        "created": "2022-02-02T16:32:58.653424",
+        "is_organization": True,
+        "approval_status": "approved",
+        "state": "active"
+    }
+    resources = []
+
+    packagemeta = deepcopy(empty_result)
+    packagemeta["id"] = resource_uri
+    packagemeta["license_id"] = resource_graphs[0][
+        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
+    packagemeta["license_url"] = resource_graphs[0][
+        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
+    packagemeta["license_title"] = resource_graphs[0][
+        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
+    packagemeta["metadata_created"] = resource_graphs[0]["created"]
+    packagemeta["metadata_modified"] = resource_graphs[0]["modified"]
+    packagemeta["name"] = clean_multilang(resource_graphs[0]["title"])
+    packagemeta["title"] = clean_multilang(resource_graphs[0]["title"])
+    packagemeta["type"] = resource_graphs[0]["asset_type"].split("/")[
+        -1].lower()
+    packagemeta["theme"] = resource_graphs[0]["theme"].split("/")[-1]
+    packagemeta["version"] = resource_graphs[0]["version"]
+
+    packagemeta["external_provider_name"] = organization_name
+    packagemeta["provider_base_url"] = providing_base_url
+
+    packagemeta["creator_user_id"] = "X"
+    packagemeta["maintainer"] = None
+    packagemeta["maintainer_email"] = None
+    packagemeta["notes"] = None
+    packagemeta["num_tags"] = 0
+    packagemeta["private"] = False
+    packagemeta["state"] = "active"
+    packagemeta["relationships_as_object"] = []
+    packagemeta["relationships_as_subject"] = []
+    packagemeta["url"] = providing_base_url
+    packagemeta["tags"] = []
+    packagemeta["groups"] = []
+
+    packagemeta["dataset_count"] = 0
+    packagemeta["service_count"] = 0
+    packagemeta["application_count"] = 0
+    packagemeta[packagemeta["type"] + "count"] = 1
+
+    for rg in representation_graphs:
+        artifact_this_res = index.by_id[rg["instance"]]
+        empty_ckan_resource = {
+            "artifact": artifact_this_res["@id"],
+            "cache_last_updated": None,
+            "cache_url": None,
+            "created": resource_graphs[0]["created"],
+            "description": clean_multilang(resource_graphs[0]["description"]),
+            "format": "EXTERNAL",
+            "hash": artifact_this_res["checkSum"],
+            "id": rg["@id"],
+            "last_modified": resource_graphs[0]["modified"],
+            "metadata_modified": rg["modified"],
+            "mimetype": rg["mediaType"],
+            "mimetype_inner": None,
+            "name": artifact_this_res["fileName"],
+            "package_id": resource_graphs[0]["sameAs"],
+            "position": 0,
+            "representation": rg["sameAs"],
+            "resource_type": "resource",
+            "size": artifact_this_res["ids:byteSize"],
+            "state": "active",
+            "url": rg["sameAs"],
+            "url_type": "upload"
+        }
+        resources.append(empty_ckan_resource)
+
+    packagemeta["organization"] = organization_data
+    packagemeta["owner_org"] = organization_data["id"]
+    packagemeta["resources"] = resources
+    packagemeta["num_resources"] = len(artifact_graphs)
+
+    return packagemeta
+
+
+def bench(n_representations, repeat=5):
+    description = make_description(n_representations)
+    index = GraphIndex(description)
+    assert ckan_result_to_client_json(
+        deepcopy_ckan_result_format(description, index)) == \
+        package_to_client_json(graphs_to_ckan_package(description, index))
+    cases = [
+        ('deepcopy path', lambda: ckan_result_to_client_json(
+            deepcopy_ckan_result_format(description, index))),
+        ('slotted path', lambda: package_to_client_json(
+            graphs_to_ckan_package(description, index))),
+    ]
+    number = max(10, 20000 // n_representations)
+    return [(name, min(timeit.repeat(func, number=number,
+                                     repeat=repeat)) / number)
+            for name, func in cases]
+
+
+def main(sizes):
+    print(f"{'representations':>15}  {'path':<22} {'us/call':>10}")
+    for n in sizes:
+        for name, seconds in bench(n):
+            print(f"{n:>15}  {name:<22} {seconds * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1, 10, 100, 1000])
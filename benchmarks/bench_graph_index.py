@@ -0,0 +1,66 @@
+"""
+Compare the linear ``@graph`` scans that ``graphs_to_ckan_result_format``
+used to do with lookups through ``clone_experiment.GraphIndex``, for
+resources with a growing number of representations.
+
+    python benchmarks/bench_graph_index.py [n_representations ...]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'interoperability'))
+
+from clone_experiment import GraphIndex, graphs_to_ckan_result_format
+from fixtures import make_description
+
+
+def linear_lookup(raw_jsonld):
+    """
+    The former lookup: one scan per ``@type`` and a scan of all artifacts
+    for every representation.
+    """
+    g = raw_jsonld["@graph"]
+    resource_graphs = [x for x in g if x["@type"] == "ids:Resource"]
+    representation_graphs = [x for x in g if
+                             x["@type"] == "ids:Representation"]
+    artifact_graphs = [x for x in g if x["@type"] == "ids:Artifact"]
+    artifacts = [x["sameAs"] for x in g if x["@type"] == "ids:Artifact"]
+    return resource_graphs, artifacts, [
+        [x for x in artifact_graphs if x["@id"] == rg["instance"]][0]
+        for rg in representation_graphs]
+
+
+def indexed_lookup(raw_jsonld):
+    index = GraphIndex(raw_jsonld)
+    artifacts = [x["sameAs"] for x in index.of_type("ids:Artifact")]
+    return index.of_type("ids:Resource"), artifacts, [
+        index.by_id[rg["instance"]]
+        for rg in index.of_type("ids:Representation")]
+
+
+def bench(n_representations, repeat=3):
+    description = make_description(n_representations)
+    assert linear_lookup(description) == indexed_lookup(description)
+    number = max(1, 2000 // n_representations)
+    rows = []
+    for name, func in [('linear lookup', linear_lookup),
+                       ('indexed lookup', indexed_lookup),
+                       ('graphs_to_ckan_result_format',
+                        graphs_to_ckan_result_format)]:
+        best = min(timeit.repeat(lambda: func(description),
+                                 number=number, repeat=repeat)) / number
+        rows.append((name, best))
+    return rows
+
+
+def main(sizes):
+    print(f"{'representations':>15}  {'function':<30} {'ms/call':>10}")
+    for n in sizes:
+        for name, seconds in bench(n):
+            print(f"{n:>15}  {name:<30} {seconds * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10, 100, 1000, 5000])
@@ -0,0 +1,153 @@
+"""
+Synthetic inputs for the benchmarks, shaped like the real data sources.
+"""
+import gzip
+import json
+import os
+import zipfile
+
+
+EDM_RECORD = """<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:ore="http://www.openarchives.org/ore/terms/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/"
+         xmlns:edm="http://www.europeana.eu/schemas/edm/"
+         xmlns:dqv="http://www.w3.org/ns/dqv#"
+         xmlns:dcterms="http://purl.org/dc/terms/">
+  <edm:ProvidedCHO rdf:about="http://data.europeana.eu/item/{dataset}/{i}"/>
+  <edm:WebResource rdf:about="http://example.org/{dataset}/{i}.jpg"/>
+  <ore:Proxy>
+    <dc:title>Synthetic record {i}</dc:title>
+    <dc:description>{description}</dc:description>
+    <dc:identifier>{dataset}-{i}</dc:identifier>
+    {subjects}
+  </ore:Proxy>
+  <ore:Aggregation>
+    <edm:rights rdf:resource="http://creativecommons.org/licenses/by/4.0/"/>
+  </ore:Aggregation>
+  <edm:EuropeanaAggregation>
+    <edm:datasetName>{dataset}_Synthetic</edm:datasetName>
+  </edm:EuropeanaAggregation>
+  <dqv:QualityAnnotation>
+    <dcterms:created>2020-01-01T00:00:00Z</dcterms:created>
+  </dqv:QualityAnnotation>
+</rdf:RDF>
+"""
+
+
+def make_edm_record(i, dataset="9200000", n_subjects=20):
+    """
+    An EDM record with the properties read by ``europeana_config`` plus
+    ``n_subjects`` unmapped ``dc:subject`` elements as ballast.
+    """
+    subjects = "\n    ".join(f"<dc:subject>Subject {j}</dc:subject>"
+                             for j in range(n_subjects))
+    return EDM_RECORD.format(i=i, dataset=dataset, subjects=subjects,
+                             description=f"Description of record {i}. " * 5)
+
+
+def write_edm_zip(path, n_records, dataset="9200000"):
+    """
+    Write a Europeana dump zip with ``n_records`` single-record .xml files
+    below a ``<dataset>/`` folder, as on the Europeana FTP server.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as _zip:
+        for i in range(n_records):
+            _zip.writestr(f"{dataset}/{i}.xml", make_edm_record(i, dataset))
+    return path
+
+
+def make_openaire_record(i, n_authors=30):
+    return {
+        "id": f"50|doi_________::{i:032x}",
+        "maintitle": f"Synthetic publication {i}",
+        "description": [f"Abstract of publication {i}. " * 10],
+        "publicationdate": "2020-01-01",
+        "publisher": "Synthetic Publisher",
+        "instance": [{"license": "http://creativecommons.org/licenses/by/4.0/",
+                      "url": [f"https://example.org/publications/{i}"]}],
+        "author": [{"fullname": f"Author {j}", "rank": j,
+                    "pid": {"id": {"scheme": "orcid",
+                                   "value": f"0000-0000-0000-{j:04d}"}}}
+                   for j in range(n_authors)],
+        "subjects": [{"subject": {"scheme": "keyword", "value": f"kw{j}"}}
+                     for j in range(10)],
+    }
+
+
+def write_openaire_gzs(dir_out, n_records, n_files=4):
+    """
+    Write ``n_records`` OpenAIRE json lines spread over ``n_files`` .gz
+    files in ``dir_out``.
+    """
+    os.makedirs(dir_out, exist_ok=True)
+    paths = [os.path.join(dir_out, f"part-{k:05d}.json.gz")
+             for k in range(n_files)]
+    files = [gzip.open(path, 'wt', encoding='utf8') for path in paths]
+    try:
+        for i in range(n_records):
+            files[i % n_files].write(json.dumps(make_openaire_record(i)))
+            files[i % n_files].write("\n")
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def make_broker_tsv(n_rows, host="connector.example.org:8080"):
+    """
+    A tabular broker response to ``sparl_get_all_resources`` with
+    ``n_rows`` rows.
+    """
+    lines = ["?resultUri\t?type\t?externalname\t?modified"]
+    for i in range(n_rows):
+        lines.append(
+            f"<https://broker.example.org/connectors/1/resources/{i}>\t"
+            f"<https://w3id.org/idsa/core/Resource>\t"
+            f"<https://{host}/api/offers/{i}>\t"
+            f"\"2022-02-03T10:00:00.000Z\"^^"
+            f"<http://www.w3.org/2001/XMLSchema#dateTimeStamp>")
+    return "\n".join(lines) + "\n"
+
+
+def make_description(n_representations, host="connector.example.org:8080",
+                     offer=1):
+    """
+    A broker description of one ``ids:Resource`` with ``n_representations``
+    representations, each with its own ``ids:Artifact``, as returned by
+    ``clone_experiment.ask_broker_for_description``.
+    """
+    base = f"https://{host}/api"
+    graph = [{
+        "@id": f"{base}/offers/{offer}",
+        "@type": "ids:Resource",
+        "sameAs": f"{base}/offers/{offer}",
+        "title": {"@language": "en", "@value": f"Synthetic resource {offer}"},
+        "description": {"@language": "en", "@value": "Benchmark fixture"},
+        "created": "2022-02-02T16:32:58.653Z",
+        "modified": "2022-02-03T10:00:00.000Z",
+        "standardLicense": "https://creativecommons.org/licenses/by/4.0/",
+        "asset_type": "https://trusts.eu/ontology/Dataset",
+        "theme": "https://trusts.eu/ontology/themes/Finance",
+        "version": "1",
+    }]
+    for i in range(n_representations):
+        artifact_id = f"{base}/artifacts/{offer}-{i}"
+        graph.append({
+            "@id": f"{base}/representations/{offer}-{i}",
+            "@type": "ids:Representation",
+            "sameAs": f"{base}/representations/{offer}-{i}",
+            "instance": artifact_id,
+            "mediaType": "text/csv",
+            "modified": "2022-02-03T10:00:00.000Z",
+        })
+        graph.append({
+            "@id": artifact_id,
+            "@type": "ids:Artifact",
+            "sameAs": artifact_id,
+            "checkSum": f"{i:032x}",
+            "fileName": f"part-{i}.csv",
+            "ids:byteSize": 1024 + i,
+        })
+    return {"@context": {"ids": "https://w3id.org/idsa/core/"},
+            "@graph": graph}
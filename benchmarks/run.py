@@ -0,0 +1,224 @@
+"""
+Time the stages of the Europeana, OpenAIRE and clone pipelines on synthetic
+data, without the FTP server or a connector, and report records/sec and
+peak RSS per stage.
+
+Every stage runs in a fresh process, so that its peak RSS is not inflated
+by the stages before it. The fixtures of a stage are generated in that
+process before the clock starts, and its peak RSS includes them.
+
+    python benchmarks/run.py -n 10000 -w 4 --json results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+
+DIR_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIR_BENCHMARKS, '..', 'interoperability'))
+sys.path.insert(0, DIR_BENCHMARKS)
+
+import fixtures
+
+from etl.sinks import SINKS
+
+
+def edm_transform_file(workdir, n, workers):
+    """
+    ``transforming.__transform_single_xml_file`` on extracted .xml files.
+    """
+    from etl import transforming
+    transform_file = getattr(transforming, '__transform_single_xml_file')
+    _zip = fixtures.write_edm_zip(os.path.join(workdir, 'dump.zip'), n)
+    with zipfile.ZipFile(_zip) as zip_ref:
+        zip_ref.extractall(os.path.join(workdir, 'unzipped'))
+        paths = [os.path.join(workdir, 'unzipped', x)
+                 for x in zip_ref.namelist()]
+    return lambda: sum(1 for x in paths if transform_file(x))
+
+
+def edm_transform_zip(workdir, n, workers):
+    """
+    ``transforming.transform`` reading the members straight from the zip,
+    with ``workers`` processes.
+    """
+    from etl.transforming import iter_zip_members, transform
+    _zip = fixtures.write_edm_zip(os.path.join(workdir, 'dump.zip'), n)
+    dir_unzipped = os.path.join(workdir, 'unzipped')
+    return lambda: sum(1 for _ in transform(
+        iter_zip_members(_zip, dir_unzipped), workers=workers))
+
+
+def openaire_files(workdir, n, workers):
+    """
+    ``openaire.openaire_file_iterable`` over gzipped json lines.
+    """
+    from openaire import openaire_file_iterable
+    fixtures.write_openaire_gzs(workdir, n)
+    return lambda: sum(1 for _ in openaire_file_iterable(workdir, workers))
+
+
+def openaire_frames(workdir, n, workers):
+    """
+    ``openaire.openaire_frame_iterable``, mapping DataFrame chunks.
+    """
+    from openaire import openaire_frame_iterable
+    fixtures.write_openaire_gzs(workdir, n)
+    return lambda: sum(len(x) for x in openaire_frame_iterable(workdir))
+
+
+def broker_tsv(workdir, n, workers):
+    """
+    ``clone_experiment.parse_broker_tabular_response`` on one response.
+    """
+    from clone_experiment import parse_broker_tabular_response
+    raw_text = fixtures.make_broker_tsv(n)
+    return lambda: len(parse_broker_tabular_response(raw_text))
+
+
+def ckan_result_format(workdir, n, workers):
+    """
+    ``clone_experiment.graphs_to_ckan_result_format`` on descriptions with
+    three representations each.
+    """
+    from clone_experiment import graphs_to_ckan_result_format
+    descriptions = [fixtures.make_description(3, offer=i) for i in range(n)]
+    return lambda: sum(1 for x in descriptions
+                       if graphs_to_ckan_result_format(x))
+
+
+def __store(kind):
+    def stage(workdir, n, workers):
+        from etl.sinks import open_sink
+        from etl.transforming import store_files
+        dir_unzipped = os.path.join(workdir, 'unzipped')
+        records = [(os.path.join(dir_unzipped, '9200000', f'{i}.xml'),
+                    __data_dict(i)) for i in range(n)]
+
+        def run():
+            with open_sink(kind, os.path.join(workdir, 'jsons')) as sink:
+                return len(store_files(records, sink, dir_unzipped))
+        return run
+    stage.__doc__ = f"``transforming.store_files`` into a {kind} sink."
+    return stage
+
+
+def __data_dict(i):
+    return {
+        'name': '9200000_Synthetic',
+        'title': f'Synthetic record {i}',
+        'notes': f'Description of record {i}. ' * 5,
+        'owner_org': 'Europeana',
+        'resources': {
+            'created': '2020-01-01T00:00:00Z',
+            'dataProvider': 'http://creativecommons.org/licenses/by/4.0/',
+            'name': '9200000_Synthetic',
+            'remoteId': f'9200000-{i}',
+            'rights': 'http://creativecommons.org/licenses/by/4.0/',
+            'url': f'http://example.org/9200000/{i}.jpg',
+            'europeana_id': str(i),
+        },
+    }
+
+
+STAGES = {
+    'edm_transform_file': edm_transform_file,
+    'edm_transform_zip': edm_transform_zip,
+    'openaire_files': openaire_files,
+    'openaire_frames': openaire_frames,
+    'broker_tsv': broker_tsv,
+    'ckan_result_format': ckan_result_format,
+}
+STAGES.update((f'store_{kind}', __store(kind)) for kind in SINKS)
+
+
+def run_stage(name, n, workers=None):
+    """
+    Run the stage ``name`` on ``n`` synthetic records in a fresh process and
+    return its measurements as a dict.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=__measure,
+                              args=(name, n, workers, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def __measure(name, n, workers, results):
+    result = {'stage': name, 'n': n, 'workers': workers}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            run = STAGES[name](workdir, n, workers)
+            start = time.perf_counter()
+            records = run()
+            seconds = time.perf_counter() - start
+        result.update(records=records, seconds=seconds,
+                      records_per_second=records / seconds,
+                      peak_rss_mb=__peak_rss_mb())
+    except Exception:
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+    results.put(result)
+
+
+def __peak_rss_mb():
+    """
+    Peak RSS of this process and its finished children, e.g. transform
+    workers, in MiB.
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def main(n, workers=None, stages=None, json_out=None):
+    results = []
+    print(f"{'stage':<20} {'records':>9} {'seconds':>9} "
+          f"{'records/s':>11} {'peak RSS MiB':>13}")
+    for name in stages or STAGES:
+        result = run_stage(name, n, workers)
+        results.append(result)
+        if 'error' in result:
+            print(f"{name:<20} failed: {result['error']}")
+        else:
+            print(f"{name:<20} {result['records']:>9} "
+                  f"{result['seconds']:>9.2f} "
+                  f"{result['records_per_second']:>11.0f} "
+                  f"{result['peak_rss_mb']:>13.1f}")
+    if json_out is not None:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline stages on synthetic data.'
+    )
+    parser.add_argument(
+        '-n', '--records', type=int, default=10000,
+        help='The number of synthetic records per stage.'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='The number of worker processes for stages that use them.'
+    )
+    parser.add_argument(
+        '-s', '--stages', nargs='+', choices=sorted(STAGES),
+        help='The stages to run, all by default.'
+    )
+    parser.add_argument(
+        '--json',
+        help='Also write the measurements to this .json file.'
+    )
+    args = parser.parse_args()
+    main(args.records, args.workers, args.stages, args.json)
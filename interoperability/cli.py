@@ -0,0 +1,217 @@
+"""
+One entry point for all pipelines:
+
+    interoperability europeana -b /data/europeana --limit 2 --pipeline
+    interoperability transform /data/europeana --from-zips -w 8
+    interoperability openaire /data/openaire /data/openaire_trusts
+    interoperability clone --env .env --profile clone.folded
+
+Every subcommand takes ``--workers``, ``--limit``, ``--metrics`` and
+``--profile``. ``--profile`` writes collapsed stacks for a flame graph, e.g.
+``flamegraph.pl clone.folded > clone.svg``, or with ``--profiler cprofile``
+a pstats file.
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+
+# The pipelines import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from etl.manifest import Manifest
+from etl.metrics import metrics
+from etl.profiling import PROFILERS, profiled
+from etl.sinks import SINKS
+
+
+def check_europeana(args):
+    if args.incremental and not args.pipeline:
+        return '-i/--incremental only works with -p/--pipeline'
+
+
+def run_europeana(europeana, args):
+    europeana.main(args.base_folder, args.limit, args.pipeline, args.workers,
+                   args.sink, args.incremental, args.metrics)
+
+
+def run_transform(transforming, args):
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(os.path.join(args.staging_area,
+                                         'manifest.sqlite'))
+    if args.metrics is not None:
+        metrics.enable()
+    transforming.main(args.staging_area, streaming=args.streaming,
+                      from_zips=args.from_zips, workers=args.workers,
+                      chunksize=args.chunksize, sink=args.sink,
+                      manifest=manifest, limit=args.limit)
+    if args.metrics is not None:
+        metrics.write(args.metrics)
+
+
+def check_openaire(args):
+    if args.vectorized and args.workers is not None and args.workers > 1:
+        return '--vectorized runs in a single process, drop -w/--workers'
+
+
+def run_openaire(openaire, args):
+    openaire.main(args.read_path, args.store_path, sink=args.sink,
+                  workers=args.workers, metrics_dir=args.metrics,
+                  vectorized=args.vectorized, limit=args.limit)
+
+
+def run_clone(clone_experiment, args):
+    config = clone_experiment.config_from_env(args.env)
+    if args.workers is not None:
+        config['max_workers'] = args.workers
+    if args.metrics is not None:
+        config['metrics_dir'] = args.metrics
+    clone_experiment.main(limit=args.limit, **config)
+
+
+def make_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '-w', '--workers', type=int,
+        help='The number of worker processes or threads.'
+    )
+    common.add_argument(
+        '-l', '--limit', type=int,
+        help='Stop after this many zips (europeana, transform) or records '
+             '(openaire, clone). A limited clone run does not advance the '
+             'sync watermark.'
+    )
+    common.add_argument(
+        '-m', '--metrics',
+        help='Write per-stage metrics.json and metrics.prom to this folder.'
+    )
+    common.add_argument(
+        '--profile',
+        help='Profile the run and write the result to this file.'
+    )
+    common.add_argument(
+        '--profiler', choices=PROFILERS, default='sampling',
+        help='sampling writes collapsed stacks of all threads for a flame '
+             'graph, cprofile pstats data of the main thread.'
+    )
+    common.add_argument(
+        '--interval', type=float, default=0.005,
+        help='Seconds between the samples of the sampling profiler.'
+    )
+    common.add_argument(
+        '--log-level', default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Show log messages of this level and above.'
+    )
+
+    parser = argparse.ArgumentParser(
+        prog='interoperability',
+        description='Run the TRUSTS interoperability pipelines.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    europeana = subparsers.add_parser(
+        'europeana', parents=[common],
+        help='Acquire and transform datasets from the Europeana FTP server.'
+    )
+    europeana.add_argument(
+        '-b', '--base_folder', required=True,
+        help='The folder to store all output.'
+    )
+    europeana.add_argument(
+        '-p', '--pipeline', action='store_true',
+        help='Overlap downloading, transforming and storing.'
+    )
+    europeana.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Skip zips that are unchanged since the last run; needs '
+             '--pipeline.'
+    )
+    europeana.set_defaults(run=run_europeana, module='europeana',
+                           check=check_europeana, subparser=europeana)
+
+    transform = subparsers.add_parser(
+        'transform', parents=[common],
+        help='Transform Europeana records already in a staging area.'
+    )
+    transform.add_argument(
+        'staging_area',
+        help='The folder with the zipped/ or unzipped/ records.'
+    )
+    transform.add_argument(
+        '--streaming', action='store_true',
+        help='Read files holding many records one record at a time.'
+    )
+    transform.add_argument(
+        '--from-zips', action='store_true',
+        help='Read the records straight from the zips.'
+    )
+    transform.add_argument(
+        '--chunksize', type=int, default=64,
+        help='The number of files sent to a worker at a time.'
+    )
+    transform.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Skip zips that are unchanged since the last run.'
+    )
+    transform.set_defaults(run=run_transform, module='etl.transforming')
+
+    openaire = subparsers.add_parser(
+        'openaire', parents=[common],
+        help='Transform an OpenAIRE dump.'
+    )
+    openaire.add_argument(
+        'read_path',
+        help='The folder with the .gz files of the dump.'
+    )
+    openaire.add_argument(
+        'store_path',
+        help='The folder to store the transformed records in.'
+    )
+    openaire.add_argument(
+        '--vectorized', action='store_true',
+        help='Map the records a DataFrame chunk at a time, in a single '
+             'process; cannot be combined with --workers.'
+    )
+    openaire.set_defaults(run=run_openaire, module='openaire',
+                          check=check_openaire, subparser=openaire)
+
+    clone = subparsers.add_parser(
+        'clone', parents=[common],
+        help='Publish the resources of a TRUSTS clone to TRUSTS main.'
+    )
+    clone.add_argument(
+        '--env', default='.env',
+        help='The settings file, see env_config.'
+    )
+    clone.set_defaults(run=run_clone, module='clone_experiment')
+
+    for subparser in (europeana, transform, openaire):
+        subparser.add_argument(
+            '-s', '--sink', choices=sorted(SINKS), default='jsonl',
+            help='How the transformed records are stored.'
+        )
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    error = args.check(args) if hasattr(args, 'check') else None
+    if error:
+        args.subparser.error(error)
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
+    # Imported up front, so that the profile does not include the imports
+    module = importlib.import_module(args.module)
+    if args.profile:
+        with profiled(args.profile, args.profiler, args.interval):
+            args.run(module, args)
+    else:
+        args.run(module, args)
+
+
+if __name__ == '__main__':
+    main()
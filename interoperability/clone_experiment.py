@@ -5,26 +5,27 @@ import requests
 import sys
 import traceback
 
-from copy import deepcopy
-from datetime import date, datetime, time, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from dotenv import dotenv_values
 from os.path import join as pathjoin
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from typing import Tuple, Dict
+from typing import Dict, Iterable, Optional, Tuple
+from urllib3.util.retry import Retry
 
 sys.path.append('path/to/file')
 
-from trusts_platform_client import trustsckan
-from trusts_platform_client.trustsckan import helper_create_contract_data, helper_load_europeana_dataset
+from connectors import ConnectorClient, ConnectorException
+from etl.cache import DescriptionCache
+from etl.dedup import DedupIndex
+from etl.ckan import CkanPackage, CkanResource
+from etl.loading import PublishLog, publish, trusts_poster
+from etl.manifest import SyncState, content_hash
+from etl.metrics import metrics
 
-log = logging.getLogger("test")
-
-class ConnectorException(Exception):
-    def __init__(self, m):
-        self.message = m
-
-    def __str__(self):
-        return "CONNECTOR_EXCEPTION " + self.message
+log = logging.getLogger(__name__)
 
 def URI(somestr: str):
     if isinstance(somestr, rdflib.URIRef):
@@ -36,53 +37,41 @@ def URI(somestr: str):
     return rdflib.URIRef(somestr)
 
 
-empty_result = {
-    "author": None,
-    "author_email": None,
-    "creator_user_id": "__MISSING__", #  (/)
-    "id": "__MISSING__",   # (/)
-    "isopen": None,    # (/)
-    "license_id": "__MISSING__",  # (/)
-    "license_title": "__MISSING__",  # (/)
-    "license_url": "__MISSING__",   # (/)
-    "maintainer": None, # (/)
-    "maintainer_email": None,  # (/)
-    "metadata_created": "__MISSING__",   # (/)
-    "metadata_modified": "__MISSING__",   # (/)
-    "name": "__MISSING__", # (/)
-    "notes": None,  # (/)
-    "num_resources": 0,  # (/)
-    "num_tags": 0, # (/)
-    "owner_org": "__MISSING__",   # (/)
-    "private": None, # (/)
-    "state": "active", # (/)
-    "theme": "__MISSING__",   # (/)
-    "title": "__MISSING__",   # (/)
-    "type": "__MISSING__",   # (/)
-    "url": None,  # (/)
-    "version": "__MISSING__",  # (/)
-    "tags": [],  # (/)
-    "groups": [],  # (/)
-    "dataset_count": 0,   # (/)
-    "service_count": 0,  # (/)
-    "application_count": 0,  # (/)
-    "relationships_as_object": [], # (/)
-    "relationships_as_subject": [], # (/)
-    "resources": [ ],
-    "organization": {}  # (/)
-}
-
-def query_broker(query_string: str, connector_url, broker_url, auth):
+def make_session(auth: Tuple[str, str], pool_size: int = 32,
+                 retries: int = 5, backoff_factor: float = 0.5):
+    """
+    A ``requests.Session`` for talking to the connector: keep-alive
+    connections pooled up to ``pool_size`` per host, basic auth set once, and
+    up to ``retries`` retries with exponential backoff on connection errors
+    and 5xx responses. The IDS endpoints only read data, so retrying their
+    POSTs is safe.
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=frozenset(["POST"]),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(auth[0], auth[1])
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def query_broker(query_string: str, connector_url, broker_url, auth,
+                 session: Optional[requests.Session] = None):
 
     params = {"recipient": broker_url}
     url = pathjoin(connector_url, "api/ids/query")
     data = query_string.encode("utf-8")
+    post = session.post if session is not None else requests.post
 
-    response = requests.post(url=url,
-                              params=params,
-                              data=data,
-                              auth=HTTPBasicAuth(auth[0],
-                                                 auth[1]))
+    response = post(url=url,
+                    params=params,
+                    data=data,
+                    auth=HTTPBasicAuth(auth[0],
+                                       auth[1]))
     if response.status_code > 299 or response.text is None:
         log.error("Got code " + str(response.status_code) + " in search")
         log.error("Provided Data: " + data.decode("utf-8"))
@@ -91,18 +80,81 @@ def query_broker(query_string: str, connector_url, broker_url, auth):
 
     return response.text
 
-def sparl_get_all_resources(resource_type: str,
-                             type_pred="https://www.trusts-data.eu/ontology/asset_type"):
+def query_broker_lines(query_string: str, connector_url, broker_url, auth,
+                       session: Optional[requests.Session] = None):
+    """
+    Like ``query_broker``, but stream the response and yield its lines as
+    they arrive instead of reading the whole body into memory.
+    """
+    params = {"recipient": broker_url}
+    url = pathjoin(connector_url, "api/ids/query")
+    data = query_string.encode("utf-8")
+    post = session.post if session is not None else requests.post
+
+    with post(url=url,
+              params=params,
+              data=data,
+              auth=HTTPBasicAuth(auth[0], auth[1]),
+              stream=True) as response:
+        if response.status_code > 299:
+            log.error("Got code " + str(response.status_code) + " in search")
+            log.error("Provided Data: " + data.decode("utf-8"))
+            raise ConnectorException("Code: " + str(response.status_code) +
+                                      " Text: " + str(response.text))
+        if response.encoding is None:
+            response.encoding = "utf-8"
+        yield from response.iter_lines(decode_unicode=True)
+
+def iter_all_resources(connector_url, broker_url, auth,
+                       resource_type: Optional[str] = None,
+                       modified_since: Optional[str] = None,
+                       page_size: int = 1000,
+                       session: Optional[requests.Session] = None):
+    """
+    Yield the rows of ``sparl_get_all_resources`` page by page, each page
+    fetched with ``LIMIT``/``OFFSET`` and parsed while it streams in, so that
+    processing can start on the first page. Stops after the first page with
+    fewer than ``page_size`` rows.
+    """
+    offset = 0
+    while True:
+        query_string = sparl_get_all_resources(resource_type,
+                                               modified_since=modified_since,
+                                               limit=page_size,
+                                               offset=offset)
+        rows = 0
+        for row in iter_broker_tabular_response(
+                query_broker_lines(query_string, connector_url, broker_url,
+                                   auth, session=session)):
+            rows += 1
+            yield row
+        if rows < page_size:
+            return
+        offset += page_size
 
+def sparl_get_all_resources(resource_type: str,
+                             type_pred="https://www.trusts-data.eu/ontology/asset_type",
+                             modified_since: Optional[str] = None,
+                             limit: Optional[int] = None,
+                             offset: int = 0):
+    """
+    With ``modified_since`` (an xsd:dateTime string, e.g. the watermark of a
+    ``SyncState``) only resources modified at or after that time, or without
+    a modification date, are selected, and their ``?modified`` is returned.
+    With ``limit`` a single page of results starting at ``offset`` is
+    selected; the rows are ordered so that consecutive pages do not overlap.
+    """
 
     query = """
       PREFIX owl: <http://www.w3.org/2002/07/owl#>
       PREFIX ids: <https://w3id.org/idsa/core/>
-      SELECT ?resultUri ?type ?externalname
+      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+      SELECT ?resultUri ?type ?externalname ?modified
       WHERE
       { ?resultUri a ?type .
         ?conn <https://w3id.org/idsa/core/offeredResource> ?resultUri .
         ?resultUri owl:sameAs ?externalname .
+        OPTIONAL { ?resultUri ids:modified ?modified . }
         """
     if resource_type is None or resource_type == "None":
         query += "\n ?resultUri " + URI(type_pred).n3() + " ?assettype."
@@ -112,174 +164,218 @@ def sparl_get_all_resources(resource_type: str,
         query += "\n ?resultUri " + URI(
             type_pred).n3() + " " + typeuri.n3() + "."
         query += "\nBIND( " + typeuri.n3() + " AS ?assettype) ."
+    if modified_since is not None:
+        query += ("\nFILTER ( !BOUND(?modified) || "
+                  "xsd:dateTime(str(?modified)) >= "
+                  "xsd:dateTime(\"" + modified_since + "\") )")
     query += "\n}"
+    if limit is not None:
+        query += ("\nORDER BY ?resultUri ?type ?externalname"
+                  "\nLIMIT " + str(int(limit)) + " OFFSET " + str(int(offset)))
     return query
 
 def parse_broker_tabular_response(raw_text, sep="\t"):
-    readrows = 0
-    result = []
-    for irow, row in enumerate(raw_text.split("\n")):
+    return list(iter_broker_tabular_response(raw_text.split("\n"), sep))
+
+def iter_broker_tabular_response(lines: Iterable[str], sep="\t"):
+    """
+    Parse the tabular broker response line by line, yielding one dict per
+    row keyed by the variable names in the header line.
+    """
+    colnames = None
+    for row in lines:
         rows = row.strip()
         if len(rows) < 1:
             continue
         vals = rows.split(sep)
-        if irow == 0:
+        if colnames is None:
             colnames = [x.replace("?", "") for x in vals]
             continue
-        d = {cname: vals[ci].strip()
+        # Unbound trailing variables leave empty cells that strip() removes
+        d = {cname: vals[ci].strip() if ci < len(vals) else ""
              for ci, cname in enumerate(colnames)}
-        result.append(d)
-
-    return result
+        yield d
 
 
 def ask_broker_for_description(element_uri: str,
                                broker_url : str,
                                connector_url : str,
-                               auth : Tuple[str,str]):
+                               auth : Tuple[str,str],
+                               session: Optional[requests.Session] = None,
+                               cache: Optional[DescriptionCache] = None,
+                               modified: Optional[str] = None):
+    """
+    The JSON-LD description of ``element_uri``. With a ``cache``, a cached
+    description is returned as long as it has not expired and was stored
+    with the same ``modified`` value, and fresh descriptions are cached.
+    """
     resource_contract_tuples = []
 
     if len(element_uri) < 5 or ":" not in element_uri:
         return {}
+    if cache is not None:
+        graphs = cache.get(element_uri, modified)
+        if graphs is not None:
+            return graphs
     params = {"recipient": broker_url,
               "elementId": element_uri}
     url = pathjoin(connector_url, "api/ids/description")
-    response = requests.post(url=url,
-                              params=params,
-                              auth=HTTPBasicAuth(auth[0], auth[1]))
+    post = session.post if session is not None else requests.post
+    response = post(url=url,
+                    params=params,
+                    auth=HTTPBasicAuth(auth[0], auth[1]))
     if response.status_code > 299 or response.text is None:
         log.error("Got code " + str(response.status_code) + " in describe")
         raise ConnectorException("Code: " + str(response.status_code) +
                                   " Text: " + str(response.text))
 
     graphs = response.json()
+    if cache is not None:
+        cache.put(element_uri, graphs, modified)
     return graphs
 
-def graphs_to_artifacts(raw_jsonld: Dict):
-    g = raw_jsonld["@graph"]
-    artifact_graphs = [x for x in g if x["@type"] == "ids:Artifact"]
-    return [x["sameAs"] for x in artifact_graphs]
+def fetch_descriptions(element_uris: Iterable[str],
+                       broker_url: str,
+                       connector_url: str,
+                       auth: Tuple[str, str],
+                       max_workers: int = 16,
+                       session: Optional[requests.Session] = None,
+                       cache: Optional[DescriptionCache] = None,
+                       modified: Optional[Dict[str, str]] = None,
+                       client: Optional[ConnectorClient] = None):
+    """
+    Ask the broker for the descriptions of all ``element_uris`` with up to
+    ``max_workers`` requests in flight over one pooled session. Yields
+    ``(element_uri, description, error)`` in the order of ``element_uris``,
+    where exactly one of ``description`` and ``error`` is ``None``, so that a
+    single failing resource does not abort the others.
+
+    With a ``cache``, descriptions are looked up there first, revalidated
+    against the ``modified`` value of their URI in the ``modified`` dict, which
+    may be filled in while ``element_uris`` is consumed.
+
+    With a ``connectors.ConnectorClient`` the requests are made by its event
+    loop instead of a thread pool, and its own cache is used.
+    """
+    if client is not None:
+        yield from client.describe_many(element_uris, modified)
+        return
+    if session is None:
+        session = make_session(auth, pool_size=max_workers)
 
-def graphs_to_ckan_result_format(raw_jsonld: Dict):
-    g = raw_jsonld["@graph"]
-    resource_graphs = [x for x in g if x["@type"] == "ids:Resource"]
-    if "theme" not in resource_graphs[0].keys():
-        return None
-    representation_graphs = [x for x in g if
-                             x["@type"] == "ids:Representation"]
-    artifact_graphs = [x for x in g if x["@type"] == "ids:Artifact"]
+    def describe(element_uri):
+        try:
+            with metrics.timer('describe'):
+                description = ask_broker_for_description(
+                    element_uri=element_uri, broker_url=broker_url,
+                    connector_url=connector_url, auth=auth,
+                    session=session, cache=cache,
+                    modified=(modified or {}).get(element_uri))
+        except Exception as e:
+            return element_uri, None, e
+        metrics.count('describe')
+        return element_uri, description, None
+
+    # Submit lazily, so that fetching starts while ``element_uris`` is still
+    # being produced, e.g. by ``iter_all_resources``
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for element_uri in element_uris:
+            in_flight.append(executor.submit(describe, element_uri))
+            if len(in_flight) >= 4 * max_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+class GraphIndex:
+    """
+    The nodes of a JSON-LD description's ``@graph``, indexed by ``@type``
+    and by ``@id`` in a single pass. Build it once per description and pass
+    it to ``graphs_to_artifacts`` and ``graphs_to_ckan_result_format``.
+    """
+
+    def __init__(self, raw_jsonld: Dict):
+        self.by_type = defaultdict(list)
+        self.by_id = {}
+        for node in raw_jsonld["@graph"]:
+            self.by_type[node.get("@type")].append(node)
+            if "@id" in node:
+                self.by_id[node["@id"]] = node
+
+    def of_type(self, node_type: str):
+        return self.by_type.get(node_type, [])
 
-    resource_uri = resource_graphs[0]["sameAs"]
+def graphs_to_artifacts(raw_jsonld: Dict, index: Optional[GraphIndex] = None):
+    index = index or GraphIndex(raw_jsonld)
+    return [x["sameAs"] for x in index.of_type("ids:Artifact")]
 
+def graphs_to_ckan_package(raw_jsonld: Dict,
+                           index: Optional[GraphIndex] = None):
     """
-    print(10*"\n"+"~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~>>")
-    print("\nresource_graphs = \n",json.dumps(resource_graphs,
-                                            indent=1).replace("\n","\n\t"))
-    print("\nartifact_graphs = \n", json.dumps(artifact_graphs,
-                                             indent=1).replace("\n", "\n\t"))
-    print("\nrepresentation_graphs = \n", json.dumps(representation_graphs,
-                                             indent=1).replace("\n", "\n\t"))
-    print("\n<<~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"+10 * "\n")
+    The CKAN view of a broker description as a ``CkanPackage``, or ``None``
+    if its resource has no theme.
     """
+    index = index or GraphIndex(raw_jsonld)
+    resource_graphs = index.of_type("ids:Resource")
+    if "theme" not in resource_graphs[0].keys():
+        return None
+    resource_graph = resource_graphs[0]
+    artifact_graphs = index.of_type("ids:Artifact")
+
+    resource_uri = resource_graph["sameAs"]
 
     # ToDo get this from the central core as well
     theirname = resource_uri
     organization_name = theirname.split("/")[2].split(":")[0]
     providing_base_url = "/".join(organization_name.split("/")[:3])
-    organization_data = {
-        "id": "52bc9332-2ba1-4c4f-bf85-5a141cd68423",
-        "name": organization_name,
-        "title": "Orga1",
-        "type": "organization",
-        "description": "",
-        "image_url": "",
-        "created": "2022-02-02T16:32:58.653424",
-        "is_organization": True,
-        "approval_status": "approved",
-        "state": "active"
-    }
-    resources = []
 
-    packagemeta = deepcopy(empty_result)
-    packagemeta["id"] = resource_uri
-    packagemeta["license_id"] = resource_graphs[0][
-        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
-    packagemeta["license_url"] = resource_graphs[0][
-        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
-    packagemeta["license_title"] = resource_graphs[0][
-        "standardLicense"] if "standardLicense" in resource_graphs[0] else None
-    packagemeta["metadata_created"] = resource_graphs[0]["created"]
-    packagemeta["metadata_modified"] = resource_graphs[0]["modified"]
-    packagemeta["name"] = clean_multilang(resource_graphs[0]["title"])
-    packagemeta["title"] = clean_multilang(resource_graphs[0]["title"])
-    packagemeta["type"] = resource_graphs[0]["asset_type"].split("/")[
-        -1].lower()
-    packagemeta["theme"] = resource_graphs[0]["theme"].split("/")[-1]
-    packagemeta["version"] = resource_graphs[0]["version"]
-
-    # These are the values we will use in succesive steps
-    packagemeta["external_provider_name"] = organization_name
-    #packagemeta["to_process_external"] = config.get(
-    #    "ckan.site_url") + "/ids/processExternal?uri=" + \
-    #                                     urllib.parse.quote_plus(
-    #                                         resource_uri)
-    packagemeta["provider_base_url"] = providing_base_url
-
-    packagemeta["creator_user_id"] = "X"
-    packagemeta["isopen"]: None
-    packagemeta["maintainer"] = None
-    packagemeta["maintainer_email"] = None
-    packagemeta["notes"] = None
-    packagemeta["num_tags"] = 0
-    packagemeta["private"] = False
-    packagemeta["state"] = "active"
-    packagemeta["relationships_as_object"] = []
-    packagemeta["relationships_as_subject"] = []
-    packagemeta["url"] = providing_base_url
-    packagemeta["tags"] = []  # (/)
-    packagemeta["groups"] = []  # (/)
-
-    packagemeta["dataset_count"] = 0
-    packagemeta["service_count"] = 0
-    packagemeta["application_count"] = 0
-    packagemeta[packagemeta["type"] + "count"] = 1
-
-    for rg in representation_graphs:
-        artifact_this_res = [x for x in artifact_graphs
-                             if x["@id"] == rg["instance"]][0]
-        # logging.error(json.dumps(artifact_this_res,indent=1)+
-        #              "\n~~~~~~~~~~~~~~~~~~~~~~~~~~~\n")
-        empty_ckan_resource = {
-            "artifact": artifact_this_res["@id"],
-            "cache_last_updated": None,
-            "cache_url": None,
-            "created": resource_graphs[0]["created"],
-            "description": clean_multilang(resource_graphs[0]["description"]),
-            "format": "EXTERNAL",
-            "hash": artifact_this_res["checkSum"],
-            "id": rg["@id"],
-            "last_modified": resource_graphs[0]["modified"],
-            "metadata_modified": rg["modified"],
-            "mimetype": rg["mediaType"],
-            "mimetype_inner": None,
-            "name": artifact_this_res["fileName"],
-            "package_id": resource_graphs[0]["sameAs"],
-            "position": 0,
-            "representation": rg["sameAs"],
-            "resource_type": "resource",
-            "size": artifact_this_res["ids:byteSize"],
-            "state": "active",
-            "url": rg["sameAs"],
-            "url_type": "upload"
-        }
-        resources.append(empty_ckan_resource)
-
-    packagemeta["organization"] = organization_data
-    packagemeta["owner_org"] = organization_data["id"]
-    packagemeta["resources"] = resources
-    packagemeta["num_resources"] = len(artifact_graphs)
-
-    return packagemeta
+    created = resource_graph["created"]
+    modified = resource_graph["modified"]
+    description = clean_multilang(resource_graph["description"])
+    resources = []
+    for rg in index.of_type("ids:Representation"):
+        artifact_this_res = index.by_id[rg["instance"]]
+        resources.append(CkanResource(
+            artifact=artifact_this_res["@id"],
+            created=created,
+            description=description,
+            hash=artifact_this_res["checkSum"],
+            id=rg["@id"],
+            last_modified=modified,
+            metadata_modified=rg["modified"],
+            mimetype=rg["mediaType"],
+            name=artifact_this_res["fileName"],
+            package_id=resource_uri,
+            representation=rg["sameAs"],
+            size=artifact_this_res["ids:byteSize"]))
+
+    return CkanPackage(
+        id=resource_uri,
+        license=resource_graph.get("standardLicense"),
+        metadata_created=created,
+        metadata_modified=modified,
+        title=clean_multilang(resource_graph["title"]),
+        type=resource_graph["asset_type"].split("/")[-1].lower(),
+        theme=resource_graph["theme"].split("/")[-1],
+        version=resource_graph["version"],
+        organization_name=organization_name,
+        provider_base_url=providing_base_url,
+        resources=resources,
+        num_resources=len(artifact_graphs))
+
+def graphs_to_ckan_result_format(raw_jsonld: Dict,
+                                 index: Optional[GraphIndex] = None):
+    package = graphs_to_ckan_package(raw_jsonld, index)
+    return package.to_dict() if package is not None else None
+
+def literal_value(n3: str):
+    """
+    The lexical value of a literal as it appears in the broker's tabular
+    response, e.g. ``"2022-02-02T16:32:58Z"^^<...#dateTimeStamp>``.
+    """
+    if not n3.startswith('"'):
+        return n3
+    return n3[1:n3.rindex('"')]
 
 def clean_multilang(astring: str):
     if isinstance(astring, str):
@@ -289,75 +385,217 @@ def clean_multilang(astring: str):
     return str(astring)
 
 
-def main(connector_url, broker_url, admin, password, ckan_token, trusts_url):
-    # Retrieving data from clone (i.e. its broker)
-    _trustsckan = trustsckan.TRUSTSCKAN(trusts_url, apikey=ckan_token)
-    contract_data = helper_create_contract_data()
+def ckan_result_to_client_json(ckan_result: Dict):
+    """
+    Map the CKAN view of a broker description, as returned by
+    ``graphs_to_ckan_result_format``, to the TRUSTS data_dict posted to
+    TRUSTS main.
+    """
+    dataset_name = ckan_result["name"].lower()
+    dataset_name = dataset_name.replace(' ', '_')
+
+    # Mapping the data into the TRUSTS format
+    json_for_client = {"name": dataset_name + "_v1",
+    "title": ckan_result['title'] + "test_clone_v1",
+    "theme": "https://trusts.poolparty.biz/Themes/18",
+    "notes": str(ckan_result["notes"]),
+    "owner_org": "Clone_node".lower(),
+    "keywords": ckan_result["tags"] + ckan_result.get("keywords",[]),
+    "resources": {"rights": ckan_result["license_url"],
+    "url": ckan_result["resources"][0]["url"] + "__v1",
+    "name":ckan_result["resources"][0]["name"]+ "test_clone_resource",
+    "dataProvider": "Interoperability Provider with the Clone",
+    "created": ckan_result["resources"][0]["created"],
+    "remoteId": ckan_result["resources"][0]['id']}}
+    return json_for_client
+
+def package_to_client_json(package: CkanPackage):
+    """
+    ``ckan_result_to_client_json`` for a ``CkanPackage``, reading its fields
+    directly instead of going through ``CkanPackage.to_dict``.
+    """
+    resource = package.resources[0]
+    return {"name": package.title.lower().replace(' ', '_') + "_v1",
+            "title": package.title + "test_clone_v1",
+            "theme": "https://trusts.poolparty.biz/Themes/18",
+            "notes": str(None),
+            "owner_org": "Clone_node".lower(),
+            "keywords": [],
+            "resources": {"rights": package.license,
+                          "url": resource.representation + "__v1",
+                          "name": resource.name + "test_clone_resource",
+                          "dataProvider":
+                              "Interoperability Provider with the Clone",
+                          "created": resource.created,
+                          "remoteId": resource.id}}
+
+
+def main(connector_url, broker_url, admin, password, ckan_token, trusts_url,
+         max_workers=16, publish_workers=4, publish_rate=None,
+         publish_log_path=None, sync_state_path=None, page_size=1000,
+         description_cache_path=None, description_ttl=None,
+         async_connector=False, metrics_dir=None, dedup_path=None,
+         limit=None):
+    if metrics_dir is not None:
+        metrics.enable()
+    # With a sync state only new or changed resources are fetched/published
+    sync_state = SyncState(sync_state_path) if sync_state_path else None
+    modified_since = sync_state.watermark() if sync_state else None
 
+    # Retrieving data from clone (i.e. its broker)
     auth = (admin, password)
-    response = query_broker(query_string=sparl_get_all_resources(None),
-                            connector_url=connector_url,
-                            broker_url=broker_url,
-                            auth=auth)
-
-    # Parsing the data from clone
-    broker_response_json = parse_broker_tabular_response(response)
-    resource_uris = set([URI(x["resultUri"])
-                                for x in broker_response_json
-                                if URI(x["type"]) == broker_response_json])
-    already_prcessed_externalnames = set()
+    session = make_session(auth, pool_size=max_workers)
 
-    # Loading the data into TRUSTS main
-    for asset in broker_response_json:
-        try:
-            print(asset)
+    # Parsing the data from clone, page by page
+    broker_rows = iter_all_resources(connector_url, broker_url, auth,
+                                     modified_since=modified_since,
+                                     page_size=page_size,
+                                     session=session)
+    already_prcessed_externalnames = set()
+    modified_by_externalname = {}
+    # The next watermark, if every resource of this run gets synced
+    latest_modified = modified_since
+    unsynced = []
+
+    def new_externalnames():
+        nonlocal latest_modified
+        for asset in broker_rows:
+            log.debug("Broker row: %s", asset)
+            metrics.count('query')
             externalname = asset["externalname"][1:-1]
             if externalname in already_prcessed_externalnames:
                 continue
             already_prcessed_externalnames.add(externalname)
-            description = ask_broker_for_description(element_uri=externalname,
-                                    broker_url=broker_url,
-                                    connector_url=connector_url,
-                                    auth=auth,
-                                    )
-            artifacts = graphs_to_artifacts(description)
-            ckan_result = graphs_to_ckan_result_format(description)
-            dataset_name = ckan_result["name"].lower()
-            dataset_name = dataset_name.replace(' ', '_')
-
-            # Mapping the data into the TRUSTS format
-            json_for_client = {"name": dataset_name + "_v1",
-            "title": ckan_result['title'] + "test_clone_v1",
-            "theme": "https://trusts.poolparty.biz/Themes/18",
-            "notes": str(ckan_result["notes"]),
-            "owner_org": "Clone_node".lower(),
-            "keywords": ckan_result["tags"] + ckan_result.get("keywords",[]),
-            "resources": {"rights": ckan_result["license_url"],
-            "url": ckan_result["resources"][0]["url"] + "__v1",
-            "name":ckan_result["resources"][0]["name"]+ "test_clone_resource",
-            "dataProvider": "Interoperability Provider with the Clone",
-            "created": ckan_result["resources"][0]["created"],
-            "remoteId": ckan_result["resources"][0]['id']}}
-            print(json.dumps(json_for_client,indent=1))
-
-            now = datetime.now()
-            then = datetime.now() + timedelta(weeks=52)
-
-            contract_data['contract_start_date'] = str(now.date())
-            contract_data['contract_start_time'] = str(now.time())
-            contract_data['contract_end_date'] = str(then.date())
-            contract_data['contract_end_time'] = str(then.time())
-            _trustsckan.post_dataset(json_for_client, contract_data)
-        except:
-            traceback.print_exc()
+            modified = literal_value(asset.get("modified", ""))
+            if modified:
+                modified_by_externalname[externalname] = modified
+                latest_modified = max(latest_modified or modified, modified)
+            if sync_state is not None and modified and \
+                    sync_state.is_unchanged(externalname, modified=modified):
+                continue
+            yield externalname
+
+    # Descriptions of unchanged resources are reused from earlier runs
+    cache = DescriptionCache(description_cache_path, ttl=description_ttl) \
+        if description_cache_path else None
+
+    # Asking for descriptions on an event loop scales to many more requests
+    # in flight than the thread pool
+    client = ConnectorClient(connector_url, broker_url, auth,
+                             max_in_flight=max_workers, cache=cache) \
+        if async_connector else None
+
+    # Loading the data into TRUSTS main
+    descriptions = fetch_descriptions(islice(new_externalnames(), limit),
+                                      broker_url=broker_url,
+                                      connector_url=connector_url,
+                                      auth=auth,
+                                      max_workers=max_workers,
+                                      session=session,
+                                      cache=cache,
+                                      modified=modified_by_externalname,
+                                      client=client)
+    pending_sync = {}
+
+    def client_jsons():
+        for externalname, description, error in descriptions:
+            try:
+                if error is not None:
+                    raise error
+                with metrics.timer('map'):
+                    package = graphs_to_ckan_package(description)
+                    if package is None:
+                        continue
+                    json_for_client = package_to_client_json(package)
+            except Exception:
+                traceback.print_exc()
+                unsynced.append(externalname)
+                continue
+            ckan_hash = content_hash(package.to_dict())
+            if sync_state is not None:
+                if sync_state.is_unchanged(externalname,
+                                           content_hash=ckan_hash):
+                    continue
+            # Keyed by content too, so that the publish log does not skip a
+            # resource that changed since it was published
+            key = externalname + " " + ckan_hash
+            pending_sync[key] = (externalname, package.metadata_modified,
+                                 ckan_hash)
+            metrics.count('map')
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Mapped %s:\n%s", externalname,
+                          json.dumps(json_for_client, indent=1))
+            yield key, json_for_client
+
+    def on_synced(key):
+        # Posted now, or already on TRUSTS main with this content
+        synced = pending_sync.pop(key)
+        if sync_state is not None:
+            sync_state.record(*synced)
+
+    publish_log = dedup = None
+    try:
+        publish_log = PublishLog(publish_log_path) \
+            if publish_log_path else None
+        # Resources already published with the same content are dropped
+        dedup = DedupIndex(dedup_path) if dedup_path else None
+        counts = publish(client_jsons(),
+                         trusts_poster(trusts_url, ckan_token),
+                         publish_log=publish_log,
+                         max_workers=publish_workers,
+                         rate=publish_rate,
+                         on_published=on_synced,
+                         dedup=dedup,
+                         on_skipped=on_synced)
+        failed = publish_log.failed() if publish_log is not None else {}
+        for key, error in failed.items():
+            log.error("Could not publish " + key + ":\n" + error)
+        log.info("Publishing done: %s", dict(counts))
+        if sync_state is not None:
+            if unsynced or pending_sync:
+                log.warning("Watermark not advanced, %s resources failed",
+                            len(unsynced) + len(pending_sync))
+            elif limit is not None:
+                # Resources past the limit may be older than those synced
+                log.info("Watermark not advanced, the run was limited to "
+                         "%s resources", limit)
+            elif latest_modified is not None:
+                sync_state.advance_watermark(latest_modified)
+    finally:
+        for resource in (dedup, client, cache, publish_log, sync_state):
+            if resource is not None:
+                resource.close()
+    if metrics_dir is not None:
+        metrics.write(metrics_dir, name='clone')
+
+
+def config_from_env(env_path=".env"):
+    """
+    The arguments of ``main`` set in the ``.env`` file at ``env_path``, see
+    ``env_config``.
+    """
+    config = dotenv_values(env_path)
+    return dict(
+        connector_url=config['CONNECTOR_URL'],
+        broker_url=config['BROKER_URL'],
+        admin=config['ADMIN'],
+        password=config['PASSWORD'],
+        ckan_token=config['CKAN_TOKEN'],
+        trusts_url=config['TRUSTS_URL'],
+        publish_log_path=config.get('PUBLISH_LOG') or None,
+        sync_state_path=config.get('SYNC_STATE') or None,
+        description_cache_path=config.get('DESCRIPTION_CACHE') or None,
+        description_ttl=float(config['DESCRIPTION_TTL'])
+        if config.get('DESCRIPTION_TTL') else None,
+        async_connector=str(config.get('ASYNC_CONNECTOR')).lower()
+        in ('1', 'true', 'yes'),
+        metrics_dir=config.get('METRICS_DIR') or None,
+        dedup_path=config.get('DEDUP_INDEX') or None,
+    )
 
 
 if __name__ == '__main__':
-    config = dotenv_values(".env")
-    main(config['CONNECTOR_URL'],
-         config['BROKER_URL'],
-         config['ADMIN'],
-         config['PASSWORD'],
-         config['CKAN_TOKEN'],
-         config['TRUSTS_URL'],
-         )
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: "
+                               "%(message)s")
+    main(**config_from_env())
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import threading
+
+from collections import deque
+from os.path import join as pathjoin
+from typing import Dict, Iterable, Optional, Tuple
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class ConnectorException(Exception):
+    def __init__(self, m):
+        self.message = m
+
+    def __str__(self):
+        return "CONNECTOR_EXCEPTION " + self.message
+
+
+class AsyncConnectorClient:
+    """
+    asyncio client for the IDS endpoints of a TRUSTS connector,
+    ``api/ids/query`` and ``api/ids/description``, forwarding to the broker
+    at ``broker_url``.
+
+    All requests share one aiohttp session with at most ``max_connections``
+    open connections, and at most ``max_in_flight`` requests are started at
+    a time. Every request is limited to ``timeout`` seconds and retried up
+    to ``retries`` times with exponential backoff on connection errors,
+    timeouts and 5xx responses; the IDS endpoints only read data, so
+    retrying their POSTs is safe. Use as ``async with`` or call ``open`` and
+    ``close`` from the event loop the client runs on.
+
+    Descriptions are looked up in and added to ``cache``, an
+    ``etl.cache.DescriptionCache``, if one is given. The cache is accessed
+    in the loop's default executor, so that its SQLite reads and writes do
+    not hold up the requests in flight.
+    """
+
+    def __init__(self, connector_url: str, broker_url: str,
+                 auth: Tuple[str, str], max_connections: int = 100,
+                 max_in_flight: int = 1000, timeout: float = 60,
+                 retries: int = 3, backoff: float = 0.5, cache=None):
+        if aiohttp is None:
+            raise ImportError("AsyncConnectorClient requires aiohttp")
+        self.connector_url = connector_url
+        self.broker_url = broker_url
+        self.auth = auth
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self._session = None
+        self._semaphore = None
+
+    async def open(self):
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.auth[0], self.auth[1]),
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def query(self, query_string: str):
+        """
+        Run the SPARQL ``query_string`` on the broker and return the tabular
+        response as text.
+        """
+        return await self._post("api/ids/query", "search",
+                                data=query_string.encode("utf-8"))
+
+    async def describe(self, element_uri: str,
+                       modified: Optional[str] = None):
+        """
+        The JSON-LD description of ``element_uri``, from the cache if it
+        holds one that is fresh for ``modified``.
+        """
+        if len(element_uri) < 5 or ":" not in element_uri:
+            return {}
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            description = await loop.run_in_executor(
+                None, self.cache.get, element_uri, modified)
+            if description is not None:
+                return description
+        description = await self._post("api/ids/description", "describe",
+                                       json_response=True,
+                                       elementId=element_uri)
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, element_uri,
+                                       description, modified)
+        return description
+
+    async def describe_safe(self, element_uri: str,
+                            modified: Optional[str] = None):
+        """
+        ``(element_uri, description, error)``, where exactly one of
+        ``description`` and ``error`` is ``None``.
+        """
+        try:
+            return element_uri, await self.describe(element_uri,
+                                                    modified), None
+        except Exception as e:
+            return element_uri, None, e
+
+    async def _post(self, endpoint, action, data=None, json_response=False,
+                    **params):
+        url = pathjoin(self.connector_url, endpoint)
+        params = dict(params, recipient=self.broker_url)
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._session.post(url, params=params,
+                                                  data=data) as response:
+                        if response.status in RETRY_STATUSES and \
+                                attempt < self.retries:
+                            log.warning("Got code %s in %s, retrying",
+                                        response.status, action)
+                        elif response.status > 299:
+                            text = await response.text()
+                            log.error("Got code " + str(response.status) +
+                                      " in " + action)
+                            raise ConnectorException(
+                                "Code: " + str(response.status) +
+                                " Text: " + text)
+                        elif json_response:
+                            return await response.json(content_type=None)
+                        else:
+                            return await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries:
+                        raise
+                    log.warning("Attempt %s to %s failed: %r",
+                                attempt + 1, action, e)
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+
+class ConnectorClient:
+    """
+    Blocking facade of ``AsyncConnectorClient`` for synchronous loaders. The
+    requests of all facades run on one event loop in a background thread,
+    see ``event_loop``, so that several loaders can keep thousands of
+    requests in flight between them without a thread per request. Takes the
+    arguments of ``AsyncConnectorClient``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._client = AsyncConnectorClient(*args, **kwargs)
+        run(self._client.open())
+
+    def query(self, query_string: str):
+        return run(self._client.query(query_string))
+
+    def describe(self, element_uri: str, modified: Optional[str] = None):
+        return run(self._client.describe(element_uri, modified))
+
+    def describe_many(self, element_uris: Iterable[str],
+                      modified: Optional[Dict[str, str]] = None):
+        """
+        Describe all ``element_uris``, with up to ``max_in_flight`` requests
+        running at a time. Yields ``(element_uri, description, error)`` in
+        the order of ``element_uris``, like
+        ``clone_experiment.fetch_descriptions``. ``modified`` maps URIs to
+        the ``modified`` value their cached description must have, and may
+        be filled in while ``element_uris`` is consumed.
+        """
+        loop = event_loop()
+        in_flight = deque()
+        for element_uri in element_uris:
+            in_flight.append(asyncio.run_coroutine_threadsafe(
+                self._client.describe_safe(
+                    element_uri, (modified or {}).get(element_uri)),
+                loop))
+            if len(in_flight) >= self._client.max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def close(self):
+        run(self._client.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """
+    The event loop shared by all ``ConnectorClient`` instances, started in
+    a daemon thread on first use.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='connectors',
+                             daemon=True).start()
+        return _loop
+
+
+def run(coroutine):
+    """
+    Run ``coroutine`` on the shared event loop and wait for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result()
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class DescriptionCache:
+    """
+    Cache of broker descriptions keyed by element URI: an in-memory LRU of at
+    most ``max_entries`` parsed descriptions in front of an SQLite table at
+    ``db_path``, so that reruns and retries do not ask the connector again.
+    Without ``db_path`` only the in-memory LRU is used.
+
+    An entry expires ``ttl`` seconds after it was fetched, and it is stale if
+    a ``modified`` value is given on lookup that differs from the one it was
+    stored with, i.e. the resource changed on the broker since.
+    """
+
+    def __init__(self, db_path=None, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            with self._db:
+                self._db.execute('''
+                    CREATE TABLE IF NOT EXISTS descriptions (
+                        uri TEXT PRIMARY KEY,
+                        modified TEXT,
+                        fetched REAL,
+                        description TEXT
+                    )
+                ''')
+
+    def get(self, uri, modified=None):
+        """
+        The cached description of ``uri``, or ``None`` if there is none or it
+        is expired or stale.
+        """
+        with self._lock:
+            entry = self._lru.get(uri)
+            if entry is not None:
+                self._lru.move_to_end(uri)
+            elif self._db is not None:
+                row = self._db.execute(
+                    'SELECT modified, fetched, description FROM descriptions '
+                    'WHERE uri = ?', (uri,)).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1], json.loads(row[2]))
+                    self._remember(uri, entry)
+        if entry is None or not self._is_fresh(entry, modified):
+            return None
+        return entry[2]
+
+    def put(self, uri, description, modified=None):
+        entry = (modified, time.time(), description)
+        with self._lock:
+            self._remember(uri, entry)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO descriptions '
+                        'VALUES (?, ?, ?, ?)',
+                        (uri, modified, entry[1], json.dumps(description)))
+
+    def invalidate(self, uri):
+        with self._lock:
+            self._lru.pop(uri, None)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        'DELETE FROM descriptions WHERE uri = ?', (uri,))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _remember(self, uri, entry):
+        self._lru[uri] = entry
+        self._lru.move_to_end(uri)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _is_fresh(self, entry, modified):
+        stored_modified, fetched, _ = entry
+        if self.ttl is not None and time.time() - fetched > self.ttl:
+            return False
+        return modified is None or stored_modified == modified
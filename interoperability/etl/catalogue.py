@@ -0,0 +1,237 @@
+import json
+import sqlite3
+import threading
+
+from datetime import datetime
+
+
+CATALOGUE_NAME = 'catalogue.sqlite'
+# Upper case only, FTS5 reads "and" as a plain word
+_FTS_OPERATORS = frozenset(['AND', 'OR', 'NOT'])
+
+
+class Catalogue:
+    """
+    Local catalogue of transformed TRUSTS records in SQLite. Every record is
+    stored as JSON under its sink key, with indexed ``remoteId``,
+    ``europeana_id``, ``owner_org`` and ``name`` columns and an FTS5 index
+    over its title and notes, so that single records, subsets to re-publish
+    and differences to CKAN are found without walking the stored files.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS records (
+                    key TEXT PRIMARY KEY,
+                    remote_id TEXT,
+                    europeana_id TEXT,
+                    owner_org TEXT,
+                    name TEXT,
+                    data TEXT,
+                    updated TEXT
+                );
+                CREATE INDEX IF NOT EXISTS records_remote_id
+                    ON records (remote_id);
+                CREATE INDEX IF NOT EXISTS records_europeana_id
+                    ON records (europeana_id);
+                CREATE INDEX IF NOT EXISTS records_owner_org
+                    ON records (owner_org);
+                CREATE INDEX IF NOT EXISTS records_name
+                    ON records (name);
+                CREATE VIRTUAL TABLE IF NOT EXISTS records_text
+                    USING fts5(title, notes);
+            ''')
+
+    def add(self, items):
+        """
+        Store ``(key, data_dict)`` pairs in one transaction, replacing the
+        records already stored under the same keys.
+        """
+        now = datetime.now().isoformat()
+        with self._lock, self._db:
+            for key, data_dict in items:
+                resources = data_dict.get('resources') or {}
+                self._db.execute(
+                    'INSERT INTO records '
+                    '(key, remote_id, europeana_id, owner_org, name, data, '
+                    'updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET '
+                    'remote_id = excluded.remote_id, '
+                    'europeana_id = excluded.europeana_id, '
+                    'owner_org = excluded.owner_org, name = excluded.name, '
+                    'data = excluded.data, updated = excluded.updated',
+                    (key, resources.get('remoteId'),
+                     resources.get('europeana_id'),
+                     data_dict.get('owner_org'), data_dict.get('name'),
+                     json.dumps(data_dict), now))
+                rowid = self._db.execute(
+                    'SELECT rowid FROM records WHERE key = ?',
+                    (key,)).fetchone()[0]
+                self._db.execute('DELETE FROM records_text WHERE rowid = ?',
+                                 (rowid,))
+                self._db.execute(
+                    'INSERT INTO records_text (rowid, title, notes) '
+                    'VALUES (?, ?, ?)',
+                    (rowid, _text(data_dict.get('title')),
+                     _text(data_dict.get('notes'))))
+
+    def clear(self):
+        """
+        Remove all stored records.
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM records')
+            self._db.execute('DELETE FROM records_text')
+
+    def get(self, key):
+        """
+        The data_dict stored under ``key``, or ``None``.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT data FROM records WHERE key = ?',
+                                   (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def find(self, remote_id=None, europeana_id=None, owner_org=None,
+             name=None, text=None, limit=None):
+        """
+        ``(key, data_dict)`` of the records matching all of the given
+        fields. ``text`` is an FTS5 query on the title and notes, e.g.
+        ``'venice AND map*'``; its matches come best first. Text that is not
+        a valid FTS5 query, e.g. ``'venice AND'``, matches the records
+        containing all of its words other than ``AND``, ``OR`` and ``NOT``; a
+        ``ValueError`` is raised if even that is not possible.
+        """
+        conditions, params = [], []
+        for column, value in [('remote_id', remote_id),
+                              ('europeana_id', europeana_id),
+                              ('owner_org', owner_org), ('name', name)]:
+            if value is not None:
+                conditions.append(f'records.{column} = ?')
+                params.append(value)
+        query = 'SELECT records.key, records.data FROM records'
+        if text is not None:
+            query += (' JOIN records_text '
+                      'ON records_text.rowid = records.rowid')
+            conditions.append('records_text MATCH ?')
+            text_index = len(params)
+            params.append(text)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        if text is not None:
+            query += ' ORDER BY records_text.rank'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+        with self._lock:
+            try:
+                rows = self._db.execute(query, params).fetchall()
+            except sqlite3.OperationalError:
+                if text is None:
+                    raise
+                params[text_index] = _fts_words(text)
+                try:
+                    rows = self._db.execute(query, params).fetchall()
+                except sqlite3.OperationalError as e:
+                    raise ValueError(
+                        f'Invalid full-text query {text!r}: {e}') from e
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def keys(self, owner_org=None):
+        """
+        The set of stored keys, optionally of one ``owner_org`` only.
+        """
+        query, params = 'SELECT key FROM records', ()
+        if owner_org is not None:
+            query, params = query + ' WHERE owner_org = ?', (owner_org,)
+        with self._lock:
+            return {row[0] for row in self._db.execute(query, params)}
+
+    def diff(self, remote_ids, owner_org=None):
+        """
+        Compare the ``remoteId`` of the stored records with ``remote_ids``,
+        e.g. those found in CKAN. Returns ``(missing, extra)``: the remote
+        IDs only stored here and those only in ``remote_ids``. Records are
+        looked up by remote ID with ``find(remote_id=...)``.
+        """
+        query = 'SELECT remote_id FROM records WHERE remote_id IS NOT NULL'
+        params = ()
+        if owner_org is not None:
+            query, params = query + ' AND owner_org = ?', (owner_org,)
+        with self._lock:
+            stored = {row[0] for row in self._db.execute(query, params)}
+        remote_ids = set(remote_ids)
+        return stored - remote_ids, remote_ids - stored
+
+    def records(self, keys=None, batch_size=1000):
+        """
+        Yield ``(key, data_dict)`` for ``keys``, or for all records, e.g. to
+        re-publish a subset with ``loading.publish``.
+        """
+        if keys is None:
+            last = 0
+            while True:
+                with self._lock:
+                    rows = self._db.execute(
+                        'SELECT rowid, key, data FROM records '
+                        'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                        (last, batch_size)).fetchall()
+                if not rows:
+                    return
+                for last, key, data in rows:
+                    yield key, json.loads(data)
+        keys = list(keys)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            placeholders = ','.join('?' * len(batch))
+            with self._lock:
+                rows = self._db.execute(
+                    f'SELECT key, data FROM records '
+                    f'WHERE key IN ({placeholders})', batch).fetchall()
+            for key, data in rows:
+                yield key, json.loads(data)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _fts_words(text):
+    """
+    An FTS5 query matching all words of ``text`` as plain terms. The
+    operators ``AND``, ``OR`` and ``NOT`` are left out rather than searched
+    for as words.
+
+    >>> _fts_words('climate AND data')
+    '"climate" "data"'
+    >>> _fts_words('venice AND map* NOT')
+    '"venice" "map*"'
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"'
+                    for word in text.split()
+                    if word not in _FTS_OPERATORS)
+
+
+def _text(value):
+    """
+    Searchable text of a title or notes, which are lists in OpenAIRE.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return '\n'.join(str(x) for x in value)
+    return str(value)
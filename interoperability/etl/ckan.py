@@ -0,0 +1,137 @@
+ORGANIZATION_ID = "52bc9332-2ba1-4c4f-bf85-5a141cd68423"
+
+
+class CkanResource:
+    """
+    One CKAN resource of a ``CkanPackage``: an ``ids:Representation`` of a
+    broker description together with its ``ids:Artifact``. Only the fields
+    that vary are stored; ``to_dict`` fills in the constant ones.
+    """
+
+    __slots__ = ("artifact", "created", "description", "hash", "id",
+                 "last_modified", "metadata_modified", "mimetype", "name",
+                 "package_id", "representation", "size")
+
+    def __init__(self, artifact, created, description, hash, id,
+                 last_modified, metadata_modified, mimetype, name,
+                 package_id, representation, size):
+        self.artifact = artifact
+        self.created = created
+        self.description = description
+        self.hash = hash
+        self.id = id
+        self.last_modified = last_modified
+        self.metadata_modified = metadata_modified
+        self.mimetype = mimetype
+        self.name = name
+        self.package_id = package_id
+        self.representation = representation
+        self.size = size
+
+    def to_dict(self):
+        return {
+            "artifact": self.artifact,
+            "cache_last_updated": None,
+            "cache_url": None,
+            "created": self.created,
+            "description": self.description,
+            "format": "EXTERNAL",
+            "hash": self.hash,
+            "id": self.id,
+            "last_modified": self.last_modified,
+            "metadata_modified": self.metadata_modified,
+            "mimetype": self.mimetype,
+            "mimetype_inner": None,
+            "name": self.name,
+            "package_id": self.package_id,
+            "position": 0,
+            "representation": self.representation,
+            "resource_type": "resource",
+            "size": self.size,
+            "state": "active",
+            "url": self.representation,
+            "url_type": "upload",
+        }
+
+
+class CkanPackage:
+    """
+    The CKAN view of an ``ids:Resource`` of a broker description, as built by
+    ``clone_experiment.graphs_to_ckan_package``. ``to_dict`` returns the
+    package dict that ``graphs_to_ckan_result_format`` returns.
+    """
+
+    __slots__ = ("id", "license", "metadata_created", "metadata_modified",
+                 "title", "type", "theme", "version", "organization_name",
+                 "provider_base_url", "resources", "num_resources")
+
+    def __init__(self, id, license, metadata_created, metadata_modified,
+                 title, type, theme, version, organization_name,
+                 provider_base_url, resources, num_resources):
+        self.id = id
+        self.license = license
+        self.metadata_created = metadata_created
+        self.metadata_modified = metadata_modified
+        self.title = title
+        self.type = type
+        self.theme = theme
+        self.version = version
+        self.organization_name = organization_name
+        self.provider_base_url = provider_base_url
+        self.resources = resources
+        self.num_resources = num_resources
+
+    def organization(self):
+        return {
+            "id": ORGANIZATION_ID,
+            "name": self.organization_name,
+            "title": "Orga1",
+            "type": "organization",
+            "description": "",
+            "image_url": "",
+            "created": "2022-02-02T16:32:58.653424",
+            "is_organization": True,
+            "approval_status": "approved",
+            "state": "active"
+        }
+
+    def to_dict(self):
+        package = {
+            "author": None,
+            "author_email": None,
+            "creator_user_id": "X",
+            "id": self.id,
+            "isopen": None,
+            "license_id": self.license,
+            "license_title": self.license,
+            "license_url": self.license,
+            "maintainer": None,
+            "maintainer_email": None,
+            "metadata_created": self.metadata_created,
+            "metadata_modified": self.metadata_modified,
+            "name": self.title,
+            "notes": None,
+            "num_resources": self.num_resources,
+            "num_tags": 0,
+            "owner_org": ORGANIZATION_ID,
+            "private": False,
+            "state": "active",
+            "theme": self.theme,
+            "title": self.title,
+            "type": self.type,
+            "url": self.provider_base_url,
+            "version": self.version,
+            "tags": [],
+            "groups": [],
+            "dataset_count": 0,
+            "service_count": 0,
+            "application_count": 0,
+            "relationships_as_object": [],
+            "relationships_as_subject": [],
+            "resources": [x.to_dict() for x in self.resources],
+            "organization": self.organization(),
+            "external_provider_name": self.organization_name,
+            "provider_base_url": self.provider_base_url,
+        }
+        package[self.type + "count"] = 1
+        return package
@@ -0,0 +1,220 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import struct
+import threading
+import unicodedata
+
+from toolz.itertoolz import partition_all
+
+
+# The fields of a TRUSTS data_dict that identify the work it describes
+FINGERPRINT_FIELDS = (('title',), ('resources', 'remoteId'),
+                      ('resources', 'url'), ('resources', 'rights'))
+
+_URL_PREFIX = re.compile(r'^[a-z][a-z0-9+.-]*://(www\.)?')
+
+
+def fingerprint(data_dict):
+    """
+    A stable 16 byte fingerprint of a TRUSTS data_dict, as produced by the
+    Europeana, OpenAIRE and clone mappings, over its normalised title,
+    remoteId, url and rights. Case, Unicode composition, whitespace, the URL
+    scheme and trailing slashes do not change it.
+
+    >>> a = {'title': 'A  Title', 'resources': {'url': 'https://x.org/1/'}}
+    >>> b = {'title': 'a title', 'resources': {'url': 'http://x.org/1'}}
+    >>> fingerprint(a) == fingerprint(b)
+    True
+    """
+    parts = []
+    for path in FINGERPRINT_FIELDS:
+        value = data_dict
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        parts.append(_normalise_url(value) if path[-1] in ('url', 'rights')
+                     else _normalise(value))
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf8'),
+                           digest_size=16).digest()
+
+
+def _normalise(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return '\x1e'.join(sorted(_normalise(x) for x in value))
+    return ' '.join(unicodedata.normalize('NFKC', str(value)).casefold()
+                    .split())
+
+
+def _normalise_url(value):
+    if isinstance(value, (list, tuple)):
+        return '\x1e'.join(sorted(_normalise_url(x) for x in value))
+    return _URL_PREFIX.sub('', _normalise(value)).rstrip('/')
+
+
+class BloomFilter:
+    """
+    A Bloom filter over 16 byte fingerprints, sized for ``capacity`` keys at
+    a false positive rate of ``error_rate``; about 1.2 bytes per key at 1%.
+    The bit positions are derived from the fingerprint itself by double
+    hashing, so no further hashing is needed.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = max(8, int(-capacity * math.log(error_rate)
+                                 / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def add(self, fp):
+        bits = self.bits
+        for position in self._positions(fp):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fp):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(fp))
+
+    def _positions(self, fp):
+        h1, h2 = struct.unpack_from('<QQ', fp)
+        h2 |= 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<Qd', self.capacity, self.error_rate))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, capacity, error_rate):
+        """
+        The filter saved at ``path``, or ``None`` if there is none for the
+        same ``capacity`` and ``error_rate``.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            header = f.read(16)
+            if struct.unpack('<Qd', header) != (capacity, error_rate):
+                return None
+            bloom = cls(capacity, error_rate)
+            f.readinto(bloom.bits)
+        return bloom
+
+
+class DedupIndex:
+    """
+    Persistent set of the fingerprints of all published records, used to
+    drop duplicates and unchanged records before they are published.
+
+    The fingerprints live in SQLite at ``db_path``; a ``BloomFilter`` in
+    front of it answers most lookups for new records without touching the
+    disk, in constant memory for up to ``capacity`` keys. The filter is
+    saved next to the database on ``close`` and rebuilt from the database
+    if that file is missing, e.g. after a crash.
+
+    ``filter`` hands out the records whose fingerprint is not published and
+    not handed out already in this run; ``record`` then stores the
+    fingerprints of those that were published and ``release`` forgets the
+    others, so a record whose publishing failed is tried again.
+    """
+
+    def __init__(self, db_path, capacity=20_000_000, error_rate=0.01):
+        self._lock = threading.Lock()
+        self._bloom_path = f'{db_path}.bloom'
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    fp BLOB PRIMARY KEY,
+                    key TEXT
+                ) WITHOUT ROWID
+            ''')
+        self._bloom = BloomFilter.load(self._bloom_path, capacity,
+                                       error_rate)
+        if self._bloom is None:
+            self._bloom = BloomFilter(capacity, error_rate)
+            for (fp,) in self._db.execute('SELECT fp FROM fingerprints'):
+                self._bloom.add(fp)
+        else:
+            # Until it is saved again, the filter on disk may miss keys
+            os.remove(self._bloom_path)
+        self._pending = {}
+        self._pending_fps = set()
+
+    def __contains__(self, fp):
+        if fp not in self._bloom:
+            return False
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM fingerprints WHERE fp = ?',
+                (fp,)).fetchone() is not None
+
+    def filter(self, items):
+        """
+        The ``(key, data_dict)`` pairs of ``items`` that are neither
+        published nor duplicates of a pair handed out before in this run.
+        """
+        fresh = []
+        for key, data_dict in items:
+            fp = fingerprint(data_dict)
+            if fp in self._pending_fps or fp in self:
+                continue
+            self._pending[key] = fp
+            self._pending_fps.add(fp)
+            fresh.append((key, data_dict))
+        return fresh
+
+    def record(self, published_keys):
+        """
+        Store the fingerprints of the records handed out by ``filter`` that
+        were published, in one transaction.
+        """
+        rows = [(self._pending.pop(key), key) for key in published_keys
+                if key in self._pending]
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO fingerprints VALUES (?, ?)', rows)
+        for fp, _ in rows:
+            self._bloom.add(fp)
+            self._pending_fps.discard(fp)
+
+    def release(self, keys):
+        """
+        Forget the records handed out by ``filter`` that were not published,
+        so that a duplicate of them later in the run is handed out instead.
+        """
+        for key in keys:
+            fp = self._pending.pop(key, None)
+            self._pending_fps.discard(fp)
+
+    def add(self, items, batch_size=10000):
+        """
+        Store the fingerprints of ``(key, data_dict)`` pairs published by
+        other means, e.g. to seed the index from an existing catalogue.
+        """
+        for batch in partition_all(batch_size, items):
+            rows = [(fingerprint(data_dict), key) for key, data_dict in batch]
+            with self._lock, self._db:
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO fingerprints VALUES (?, ?)', rows)
+            for fp, _ in rows:
+                self._bloom.add(fp)
+
+    def close(self):
+        self._bloom.save(self._bloom_path)
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,82 @@
+from lxml import etree
+
+from etl.mappings import (EUROPEANA_DATA_DICT_MAPPING,
+                          EUROPEANA_RESOURCES_MAPPING)
+
+
+EDM_NAMESPACES = {
+    'cc': 'http://creativecommons.org/ns#',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'doap': 'http://usefulinc.com/ns/doap#',
+    'dqv': 'http://www.w3.org/ns/dqv#',
+    'ebucore': 'http://www.ebu.ch/metadata/ontologies/ebucore/ebucore#',
+    'edm': 'http://www.europeana.eu/schemas/edm/',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'odrl': 'http://www.w3.org/ns/odrl/2/',
+    'ore': 'http://www.openarchives.org/ore/terms/',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'rdaGr2': 'http://rdvocab.info/ElementsGr2/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'svcs': 'http://rdfs.org/sioc/services#',
+    'wgs84_pos': 'http://www.w3.org/2003/01/geo/wgs84_pos#',
+}
+
+RDF_RECORD_TAG = f"{{{EDM_NAMESPACES['rdf']}}}RDF"
+
+
+class XPathExtractor:
+    """
+    Evaluate a ``{key: xpath}`` mapping against EDM records. The expressions
+    are compiled once, when the extractor is built, against the fixed
+    ``namespaces`` table instead of the nsmap of every parsed document.
+    """
+
+    def __init__(self, mapping, namespaces=EDM_NAMESPACES):
+        self._xpaths = [(key, etree.XPath(xpath, namespaces=namespaces))
+                        for key, xpath in mapping.items()]
+
+    def __call__(self, node):
+        return {key: xpath(node) for key, xpath in self._xpaths}
+
+
+class EuropeanaRecordExtractor:
+    """
+    Turn Europeana EDM records into TRUSTS data_dicts. Each document is parsed
+    exactly once and all fields of both mappings are evaluated on the same
+    tree.
+    """
+
+    def __init__(self, data_dict_mapping=EUROPEANA_DATA_DICT_MAPPING,
+                 resources_mapping=EUROPEANA_RESOURCES_MAPPING,
+                 namespaces=EDM_NAMESPACES):
+        self._extract_data_dict = XPathExtractor(data_dict_mapping, namespaces)
+        self._extract_resources = XPathExtractor(resources_mapping, namespaces)
+        self._extract_record_id = etree.XPath(
+            'string(edm:ProvidedCHO/@rdf:about)', namespaces=namespaces)
+
+    def from_file(self, xml_file, europeana_id):
+        """
+        Parse ``xml_file`` (a path or a file-like object) and transform it.
+        """
+        return self.from_element(etree.parse(xml_file).getroot(),
+                                 europeana_id)
+
+    def record_id(self, record):
+        """
+        Read the Europeana ID of ``record`` from the ``rdf:about`` of its
+        ``edm:ProvidedCHO``, i.e. the last segment of the item URI.
+        """
+        return self._extract_record_id(record).rstrip('/').split('/')[-1]
+
+    def from_element(self, record, europeana_id):
+        """
+        Transform an already parsed ``rdf:RDF`` element.
+        """
+        data_dict = self._extract_data_dict(record)
+        data_dict['owner_org'] = 'Europeana'
+        resources = self._extract_resources(record)
+        resources['europeana_id'] = europeana_id
+        data_dict['resources'] = resources
+        return data_dict
@@ -1,39 +1,229 @@
+import hashlib
+import ftplib
+import logging
 import os
+import threading
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
 from ftplib import FTP
 from toolz.itertoolz import partition_all
 
+from etl.metrics import metrics
+
 
 FTP_HOST_EUROPEANA = 'download.europeana.eu'
+FTP_DIR_EUROPEANA = 'dataset/XML'
+
+log = logging.getLogger(__name__)
+
+
+class ChecksumError(Exception):
+    def __init__(self, fname, expected, actual):
+        self.message = (f"{fname}: expected md5 {expected}, "
+                        f"got {actual}")
+
+    def __str__(self):
+        return "CHECKSUM_ERROR " + self.message
 
 
-def europeana_file_iterable(path_staging_area, batch_size, url_ftp_host):
+def europeana_file_iterable(path_staging_area, batch_size, url_ftp_host,
+                            extract=True, n_connections=1, port=21,
+                            ftp_dir=FTP_DIR_EUROPEANA, manifest=None):
     """
     Iterate over the zipped files in ``path_to_dataset`` until ``until`` is
     reached, unzip them, and extract the relevant properties as json files.
+    With ``extract=False`` the zips are only downloaded; they can then be
+    transformed in place with ``transforming.main(..., from_zips=True)``.
+    Each batch is downloaded over ``n_connections`` parallel connections, see
+    ``download_zips``. If a ``manifest.Manifest`` is given, zips that are
+    listed unchanged since they were last stored are skipped and every new
+    download is recorded in it.
     """
-    ftp = ftp_login(url_ftp_host)
-    zips = [x for x in ftp.nlst() if not x.endswith('md5sum')]
+    ftp = ftp_login(url_ftp_host, port, ftp_dir)
+    listing, checksums = list_remote_zips(ftp)
+    ftp.quit()
+    zips = [x for x, (size, mtime) in listing.items()
+            if manifest is None or not manifest.is_current(x, size, mtime)]
+
+    def on_downloaded(fpath, md5):
+        if manifest is not None:
+            manifest.mark_downloaded(os.path.basename(fpath),
+                                     *listing[os.path.basename(fpath)], md5)
 
     for batch in partition_all(batch_size, zips):
+        dir_zipped = os.path.join(path_staging_area, 'zipped')
+        download_zips(batch, dir_zipped, url_ftp_host, n_connections, port,
+                      ftp_dir, checksums=checksums,
+                      on_downloaded=on_downloaded)
         for _zip in batch:
             zip_name = os.path.splitext(_zip)[0]
             dir_zipped, dir_unzipped = \
                 __create_folders(path_staging_area, zip_name)
-            __download_zipfile(ftp, dir_zipped, _zip)
-            __unzip(dir_unzipped, os.path.join(dir_zipped, _zip))
+            if extract:
+                __unzip(dir_unzipped, os.path.join(dir_zipped, _zip))
         yield
 
 
-def ftp_login(url_ftp_host):
-    ftp = FTP(url_ftp_host)
+def ftp_login(url_ftp_host, port=21, ftp_dir=FTP_DIR_EUROPEANA):
+    ftp = FTP()
+    ftp.connect(url_ftp_host, port)
     ftp.login()
-    ftp.cwd('dataset/XML')
+    ftp.cwd(ftp_dir)
 
     return ftp
 
 
+def list_remote_zips(ftp):
+    """
+    List the zips in the current directory of ``ftp`` as a ``{name: (size,
+    mtime)}`` dict, in server order, together with the set of ``.md5sum``
+    files. Uses ``MLSD`` where the server supports it and falls back to
+    ``NLST`` plus ``SIZE``/``MDTM`` otherwise.
+    """
+    try:
+        entries = [(name, facts) for name, facts in ftp.mlsd()
+                   if facts.get('type', 'file') == 'file']
+    except ftplib.error_perm:
+        entries = [(name, None) for name in ftp.nlst()]
+        # NLST switches to ASCII mode, in which servers may refuse SIZE
+        ftp.voidcmd('TYPE I')
+    zips = {}
+    checksums = set()
+    for name, facts in entries:
+        if name.endswith('md5sum'):
+            checksums.add(name)
+        elif facts is not None:
+            zips[name] = (int(facts['size']), facts.get('modify'))
+        else:
+            zips[name] = (ftp.size(name), ftp.voidcmd(f'MDTM {name}')[4:])
+    return zips, checksums
+
+
+def download_zips(zips, to_dir, url_ftp_host=FTP_HOST_EUROPEANA,
+                  n_connections=4, port=21, ftp_dir=FTP_DIR_EUROPEANA,
+                  checksums=None, max_attempts=3, on_downloaded=None):
+    """
+    Download ``zips`` into ``to_dir`` over a pool of ``n_connections`` FTP
+    connections and return their local paths.
+
+    A partially downloaded file is resumed from its current size with a
+    ``REST`` offset. Every zip is checked against its published
+    ``<zip>.md5sum`` companion, and zips that are already present and verified
+    are skipped. ``checksums`` is the set of ``.md5sum`` names on the server;
+    if it is not given, the remote directory is listed to find them. A
+    transfer that drops or fails verification is retried up to
+    ``max_attempts`` times before the error is raised. ``on_downloaded`` is
+    called with the local path and md5 of every verified zip from the
+    downloading thread; if it blocks, that connection stops downloading.
+    """
+    os.makedirs(to_dir, exist_ok=True)
+    connections = []
+    local = threading.local()
+
+    def connection():
+        if getattr(local, 'ftp', None) is None:
+            local.ftp = ftp_login(url_ftp_host, port, ftp_dir)
+            connections.append(local.ftp)
+        return local.ftp
+
+    def disconnect():
+        # The next connection() logs in again, inside the retry loop
+        ftp = getattr(local, 'ftp', None)
+        local.ftp = None
+        if ftp is not None:
+            connections.remove(ftp)
+            __close(ftp)
+
+    if checksums is None:
+        checksums = {x for x in connection().nlst() if x.endswith('md5sum')}
+
+    def download(fname):
+        for attempt in range(1, max_attempts + 1):
+            try:
+                with metrics.timer('download'):
+                    fpath, md5 = __download_verified(
+                        connection(), to_dir, fname,
+                        f'{fname}.md5sum' in checksums)
+                break
+            except (ChecksumError, EOFError, OSError,
+                    ftplib.Error) as e:
+                if attempt == max_attempts:
+                    raise
+                log.warning("Attempt %s for %s failed: %s", attempt, fname, e)
+                disconnect()
+        metrics.count('download')
+        metrics.add_bytes('download', os.path.getsize(fpath))
+        if on_downloaded is not None:
+            on_downloaded(fpath, md5)
+        return fpath
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            return list(executor.map(download, zips))
+    finally:
+        for ftp in connections:
+            __close(ftp)
+
+
+def __download_verified(ftp, to_dir, fname, has_checksum):
+    """
+    Download ``fname`` unless a verified copy exists, resuming a partial
+    download, and check it against its md5sum if ``has_checksum``. Returns
+    the local path and md5 of the zip.
+    """
+    fpath = os.path.join(to_dir, fname)
+    expected_md5 = __read_remote_md5(ftp, fname) if has_checksum else None
+    ftp.voidcmd('TYPE I')
+    remote_size = ftp.size(fname)
+    local_size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+
+    if local_size == remote_size and __is_verified(fpath, expected_md5):
+        return fpath, expected_md5 or __md5(fpath)
+    if local_size >= remote_size:
+        # Complete but corrupt, or larger than the remote file: start over
+        local_size = 0
+    with open(fpath, 'ab' if local_size else 'wb') as f:
+        ftp.retrbinary(f'RETR {fname}', f.write, rest=local_size or None)
+
+    actual_md5 = __md5(fpath)
+    if expected_md5 is not None and actual_md5 != expected_md5:
+        os.remove(fpath)
+        raise ChecksumError(fname, expected_md5, actual_md5)
+    return fpath, actual_md5
+
+
+def __read_remote_md5(ftp, fname):
+    """
+    Read the md5 hex digest from the ``<fname>.md5sum`` file on the server.
+    These files contain ``<digest>`` or ``<digest>  <fname>``.
+    """
+    lines = []
+    ftp.retrlines(f'RETR {fname}.md5sum', lines.append)
+    return ' '.join(lines).split()[0].lower()
+
+
+def __is_verified(fpath, expected_md5):
+    if expected_md5 is None:
+        return True
+    return __md5(fpath) == expected_md5
+
+
+def __md5(fpath, blocksize=1 << 20):
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def __close(ftp):
+    try:
+        ftp.quit()
+    except (EOFError, OSError, ftplib.Error):
+        ftp.close()
+
+
 def __create_folders(base_folder, zip_name):
     """
     Creates the folder structure needed to hold zipped and unzipped data and
@@ -43,19 +233,14 @@ def __create_folders(base_folder, zip_name):
     dir_unzipped = os.path.join(base_folder, 'unzipped', zip_name)
     for _dir in [dir_zipped, dir_unzipped]:
         if not os.path.exists(_dir):
-            print(_dir)
+            log.info("Creating %s", _dir)
             os.makedirs(_dir)
     return dir_zipped, dir_unzipped
 
 
-def __download_zipfile(ftp, to_dir, fname):
-    """
-    Downloads and stores the given zipfile from the ftp server.
-    """
-    with open(os.path.join(to_dir, fname), 'wb') as f:
-        ftp.retrbinary(f'RETR {fname}', f.write)
-
-
 def __unzip(to_dir, _zip):
-    with zipfile.ZipFile(_zip, 'r') as zip_ref:
+    with metrics.timer('unzip'), zipfile.ZipFile(_zip, 'r') as zip_ref:
+        members = zip_ref.infolist()
         zip_ref.extractall(to_dir)
+    metrics.count('unzip', len(members))
+    metrics.add_bytes('unzip', sum(member.file_size for member in members))
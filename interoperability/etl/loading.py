@@ -0,0 +1,232 @@
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from toolz.itertoolz import partition_all
+
+from trusts_platform_client import trustsckan
+from trusts_platform_client.trustsckan import helper_create_contract_data
+
+from etl.metrics import metrics
+from etl.sinks import read_records
+
+
+PUBLISHED = 'published'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+DUPLICATE = 'duplicate'
+
+log = logging.getLogger(__name__)
+
+
+class PublishLog:
+    """
+    Per-item outcome of publishing, kept in SQLite so that a rerun only
+    retries what failed and never re-publishes what already succeeded.
+    """
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS outcomes (
+                    key TEXT PRIMARY KEY,
+                    status TEXT,
+                    attempts INTEGER,
+                    error TEXT,
+                    updated TEXT
+                )
+            ''')
+
+    def published(self, keys):
+        """
+        The subset of ``keys`` that has been published successfully.
+        """
+        keys = list(keys)
+        placeholders = ','.join('?' * len(keys))
+        rows = self._db.execute(
+            f'SELECT key FROM outcomes '
+            f'WHERE status = ? AND key IN ({placeholders})',
+            [PUBLISHED] + keys)
+        return {row[0] for row in rows}
+
+    def failed(self):
+        """
+        The keys whose last publishing attempt failed, with their errors.
+        """
+        return dict(self._db.execute(
+            'SELECT key, error FROM outcomes WHERE status = ?', (FAILED,)))
+
+    def record(self, outcomes):
+        """
+        Store ``(key, status, attempts, error)`` tuples in one transaction.
+        """
+        now = datetime.now().isoformat()
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?)',
+                [outcome + (now,) for outcome in outcomes])
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RateLimiter:
+    """
+    Token bucket allowing on average ``rate`` calls per second, with bursts
+    of up to ``burst`` calls. Safe to share between threads.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens
+                                   + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self.rate)
+
+
+def trusts_poster(trusts_url, ckan_token, contract_weeks=52):
+    """
+    Return a function that posts one TRUSTS data_dict to the TRUSTS CKAN at
+    ``trusts_url``, with a contract starting now and running for
+    ``contract_weeks``.
+    """
+    _trustsckan = trustsckan.TRUSTSCKAN(trusts_url, apikey=ckan_token)
+    template = helper_create_contract_data()
+
+    def post(data_dict):
+        now = datetime.now()
+        then = now + timedelta(weeks=contract_weeks)
+        contract_data = dict(template,
+                             contract_start_date=str(now.date()),
+                             contract_start_time=str(now.time()),
+                             contract_end_date=str(then.date()),
+                             contract_end_time=str(then.time()))
+        return _trustsckan.post_dataset(data_dict, contract_data)
+
+    return post
+
+
+def publish(items, post, publish_log=None, max_workers=4, batch_size=100,
+            rate=None, max_attempts=3, backoff=1.0, on_published=None,
+            dedup=None, on_skipped=None):
+    """
+    Publish ``(key, data_dict)`` pairs with ``post`` and return a ``Counter``
+    of the outcomes.
+
+    Items are taken ``batch_size`` at a time and posted by ``max_workers``
+    threads, at most ``rate`` posts per second overall if ``rate`` is given.
+    A failing post is retried up to ``max_attempts`` times with exponential
+    ``backoff``. With a ``PublishLog`` every outcome is recorded, one
+    transaction per batch, and keys it already lists as published are
+    skipped, so that an interrupted or partly failed run can simply be
+    repeated. ``on_published`` is called with the key of every item that was
+    posted successfully. With a ``dedup.DedupIndex``, items whose content
+    fingerprint was published before, under any key, or that duplicate an
+    earlier item of this run are counted as duplicates and not posted.
+    ``on_skipped`` is called with the key of every item that was skipped as
+    already published or as a duplicate.
+    """
+    limiter = RateLimiter(rate, burst=max_workers) if rate else None
+
+    def publish_one(item):
+        key, data_dict = item
+        for attempt in range(1, max_attempts + 1):
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                with metrics.timer('publish'):
+                    post(data_dict)
+            except Exception:
+                error = traceback.format_exc()
+                log.warning("Publishing %s failed (attempt %s of %s)",
+                            key, attempt, max_attempts)
+                if attempt < max_attempts:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+                continue
+            metrics.count('publish')
+            if on_published is not None:
+                on_published(key)
+            return key, PUBLISHED, attempt, None
+        metrics.count('publish_failed')
+        return key, FAILED, max_attempts, error
+
+    counts = Counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in partition_all(batch_size, items):
+            if publish_log is not None:
+                done = publish_log.published(key for key, _ in batch)
+                counts[SKIPPED] += len(done)
+                batch = __notify_skipped(
+                    [item for item in batch if item[0] not in done], batch,
+                    on_skipped)
+            if dedup is not None:
+                fresh = dedup.filter(batch)
+                counts[DUPLICATE] += len(batch) - len(fresh)
+                batch = __notify_skipped(fresh, batch, on_skipped)
+            outcomes = list(executor.map(publish_one, batch))
+            counts.update(status for _, status, _, _ in outcomes)
+            if publish_log is not None:
+                publish_log.record(outcomes)
+            if dedup is not None:
+                dedup.record(key for key, status, _, _ in outcomes
+                             if status == PUBLISHED)
+                dedup.release(key for key, status, _, _ in outcomes
+                              if status != PUBLISHED)
+    return counts
+
+
+def __notify_skipped(kept, batch, on_skipped):
+    """
+    Call ``on_skipped`` with the keys of the items of ``batch`` that are not
+    ``kept`` and return ``kept``.
+    """
+    if on_skipped is not None:
+        kept_keys = {key for key, _ in kept}
+        for key, _ in batch:
+            if key not in kept_keys:
+                on_skipped(key)
+    return kept
+
+
+def publish_stored(dir_out, trusts_url, ckan_token, publish_log=None,
+                   manifest=None, **kwargs):
+    """
+    Publish the Europeana or OpenAIRE records a sink stored below ``dir_out``,
+    keyed by their Europeana ID or remote ID. With a ``manifest.Manifest``
+    only the records of the zips it lists as stored are published. ``kwargs``
+    are passed on to ``publish``.
+    """
+    locations = manifest.locations() if manifest is not None else None
+    items = ((__record_key(data_dict), data_dict)
+             for data_dict in read_records(dir_out, locations))
+    return publish(items, trusts_poster(trusts_url, ckan_token),
+                   publish_log=publish_log, **kwargs)
+
+
+def __record_key(data_dict):
+    resources = data_dict['resources']
+    return resources.get('europeana_id') or resources['remoteId']
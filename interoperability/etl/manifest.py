@@ -0,0 +1,229 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+from datetime import datetime
+
+
+DOWNLOADED = 'downloaded'
+STORED = 'stored'
+
+
+class Manifest:
+    """
+    Persistent record of what an incremental Europeana run has already done.
+
+    For every zip the manifest keeps the size and modification time listed by
+    the FTP server, the md5 of the verified download and its processing
+    status; for every stored record it keeps the zip it came from and the
+    location returned by the sink. A zip whose listed size and mtime are
+    unchanged and whose status is ``stored`` does not need to be fetched or
+    transformed again.
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS zips (
+                    name TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime TEXT,
+                    md5 TEXT,
+                    status TEXT,
+                    updated TEXT
+                );
+                CREATE TABLE IF NOT EXISTS records (
+                    key TEXT PRIMARY KEY,
+                    zip_name TEXT,
+                    location TEXT
+                );
+                CREATE INDEX IF NOT EXISTS records_zip_name
+                    ON records (zip_name);
+            ''')
+
+    def is_current(self, zip_name, size=None, mtime=None):
+        """
+        Whether ``zip_name`` has been stored and, if ``size`` and ``mtime``
+        are given, is still listed with the same size and mtime.
+        """
+        row = self.__query_one(
+            'SELECT size, mtime, status FROM zips WHERE name = ?',
+            (_zip_name(zip_name),))
+        if row is None or row[2] != STORED:
+            return False
+        return ((size is None or row[0] == size)
+                and (mtime is None or row[1] == mtime))
+
+    def mark_downloaded(self, zip_name, size, mtime, md5):
+        """
+        Record a verified download. This resets the status of a zip that was
+        stored before, since its content may have changed.
+        """
+        zip_name = _zip_name(zip_name)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO zips VALUES (?, ?, ?, ?, ?, ?)',
+                (zip_name, size, mtime, md5, DOWNLOADED, _now()))
+
+    def mark_stored(self, zip_name, locations):
+        """
+        Record that all records of ``zip_name`` are stored. ``locations`` is
+        an iterable of ``(key, location)`` pairs, which replaces the records
+        previously stored for this zip.
+        """
+        zip_name = _zip_name(zip_name)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM records WHERE zip_name = ?',
+                             (zip_name,))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+                ((key, zip_name, location) for key, location in locations))
+            self._db.execute(
+                'INSERT INTO zips (name, status, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET '
+                'status = excluded.status, updated = excluded.updated',
+                (zip_name, STORED, _now()))
+
+    def location(self, key):
+        """
+        Where the record ``key`` was stored, or ``None``.
+        """
+        row = self.__query_one('SELECT location FROM records WHERE key = ?',
+                               (key,))
+        return None if row is None else row[0]
+
+    def locations(self):
+        """
+        The locations of the records of all zips marked as stored, leaving
+        out those of zips downloaded again but not yet stored, e.g. for
+        ``sinks.read_records``.
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT records.location FROM records '
+                'JOIN zips ON zips.name = records.zip_name '
+                'WHERE zips.status = ?', (STORED,))]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __query_one(self, sql, params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+
+class SyncState:
+    """
+    Persistent state of the incremental broker sync: for every resource URI
+    the last ``modified`` value and the content hash of what was published,
+    and the watermark the next broker query filters on.
+
+    The watermark only moves on with ``advance_watermark`` at the end of a
+    run that synced every resource it was shown. Resources that failed or
+    were left out of a partial run may be older than the newest one synced,
+    so they are still queried the next time.
+
+    >>> state = SyncState(':memory:')
+    >>> state.record('https://clone/offers/0', '2022-02-03T00:00:00Z', 'h0')
+    >>> state.watermark() is None
+    True
+    >>> state.advance_watermark('2022-02-03T00:00:00Z')
+    >>> state.watermark()
+    '2022-02-03T00:00:00Z'
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS resources (
+                    uri TEXT PRIMARY KEY,
+                    modified TEXT,
+                    content_hash TEXT,
+                    updated TEXT
+                );
+                CREATE TABLE IF NOT EXISTS runs (
+                    watermark TEXT,
+                    finished TEXT
+                );
+            ''')
+
+    def watermark(self):
+        """
+        The watermark of the last complete run, or ``None`` if there was
+        none yet.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT watermark FROM runs ORDER BY rowid DESC LIMIT 1'
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def advance_watermark(self, watermark):
+        """
+        Record a run that synced every resource the broker listed as
+        modified at or before ``watermark``, the latest ``modified`` value
+        it saw.
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO runs VALUES (?, ?)',
+                             (watermark, _now()))
+
+    def is_unchanged(self, uri, modified=None, content_hash=None):
+        """
+        Whether ``uri`` was synced before with the same ``modified`` value
+        and/or ``content_hash``, whichever of the two are given.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT modified, content_hash FROM resources WHERE uri = ?',
+                (uri,)).fetchone()
+        if row is None or (modified is None and content_hash is None):
+            return False
+        return ((modified is None or row[0] == modified)
+                and (content_hash is None or row[1] == content_hash))
+
+    def record(self, uri, modified, content_hash):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?)',
+                (uri, modified, content_hash, _now()))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def content_hash(data_dict):
+    """
+    A stable hash of a json-serialisable dict, independent of key order.
+    """
+    encoded = json.dumps(data_dict, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode('utf8')).hexdigest()
+
+
+def _zip_name(zip_name):
+    """
+    >>> _zip_name('2048128.zip')
+    '2048128'
+    """
+    return zip_name[:-4] if zip_name.endswith('.zip') else zip_name
+
+
+def _now():
+    return datetime.now().isoformat()
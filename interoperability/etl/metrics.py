@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import nullcontext
+
+
+class Metrics:
+    """
+    Per-stage timers, record counters and byte counters of an ETL run, e.g.
+    for the stages ``download``, ``unzip``, ``parse``, ``map``, ``store`` and
+    ``publish``. Safe to use from several threads. Worker processes work on
+    their own copy, which is enabled if they were forked from a process
+    that had enabled it, but whose counts never reach the parent, so stages
+    that run in a process pool are only counted where their results arrive.
+
+    While disabled, ``timer`` returns a shared no-op context manager and the
+    counters return immediately, so instrumented code costs next to nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def reset(self):
+        with self._lock:
+            self._seconds = defaultdict(float)
+            self._calls = defaultdict(int)
+            self._records = defaultdict(int)
+            self._bytes = defaultdict(int)
+            self._started = time.time()
+
+    def timer(self, stage):
+        """
+        Context manager adding the time spent in its block to ``stage``.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def count(self, stage, n=1):
+        """
+        Add ``n`` records processed by ``stage``.
+        """
+        if self.enabled:
+            with self._lock:
+                self._records[stage] += n
+
+    def add_bytes(self, stage, n):
+        """
+        Add ``n`` bytes read or written by ``stage``.
+        """
+        if self.enabled:
+            with self._lock:
+                self._bytes[stage] += n
+
+    def summary(self):
+        """
+        ``{stage: {seconds, calls, records, bytes, records_per_second}}``
+        """
+        with self._lock:
+            stages = sorted(set(self._seconds) | set(self._records)
+                            | set(self._bytes))
+            summary = {}
+            for stage in stages:
+                seconds = self._seconds.get(stage, 0.0)
+                records = self._records.get(stage, 0)
+                summary[stage] = {
+                    'seconds': seconds,
+                    'calls': self._calls.get(stage, 0),
+                    'records': records,
+                    'bytes': self._bytes.get(stage, 0),
+                    'records_per_second':
+                        records / seconds if seconds else None,
+                }
+            return summary
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(
+            {'started': self._started, 'finished': time.time(),
+             'stages': self.summary()}, indent=1))
+
+    def write_prometheus(self, path, prefix='interoperability'):
+        """
+        Write the metrics in the Prometheus text format, e.g. for the
+        node_exporter textfile collector. The file is replaced atomically so
+        the collector never reads a partial file.
+        """
+        summary = self.summary()
+        lines = []
+        for name, key, kind, help_text in [
+                ('stage_seconds_total', 'seconds', 'counter',
+                 'Time spent in the stage.'),
+                ('stage_calls_total', 'calls', 'counter',
+                 'Number of timed blocks of the stage.'),
+                ('stage_records_total', 'records', 'counter',
+                 'Records processed by the stage.'),
+                ('stage_bytes_total', 'bytes', 'counter',
+                 'Bytes read or written by the stage.')]:
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            for stage, values in summary.items():
+                lines.append(f'{prefix}_{name}{{stage="{stage}"}} '
+                             f'{values[key]}')
+        lines.append(f'# HELP {prefix}_last_run_timestamp_seconds '
+                     f'End of the last run.')
+        lines.append(f'# TYPE {prefix}_last_run_timestamp_seconds gauge')
+        lines.append(f'{prefix}_last_run_timestamp_seconds {time.time()}')
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+    def write(self, dir_out, name='metrics'):
+        """
+        Write ``<name>.json`` and ``<name>.prom`` to ``dir_out``.
+        """
+        os.makedirs(dir_out, exist_ok=True)
+        self.write_json(os.path.join(dir_out, f'{name}.json'))
+        self.write_prometheus(os.path.join(dir_out, f'{name}.prom'))
+
+    def _add_time(self, stage, seconds):
+        with self._lock:
+            self._seconds[stage] += seconds
+            self._calls[stage] += 1
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics._add_time(self.stage, time.perf_counter() - self.start)
+
+
+_NULL_TIMER = nullcontext()
+
+
+def _write_atomic(path, text):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# The instance the pipelines report to; ``metrics.enable()`` to collect
+metrics = Metrics()
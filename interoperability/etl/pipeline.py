@@ -0,0 +1,187 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from etl.extracting import (FTP_DIR_EUROPEANA, FTP_HOST_EUROPEANA,
+                            download_zips, ftp_login, list_remote_zips)
+from etl.sinks import open_sink
+from etl.transforming import iter_zip_members, store_files, transform
+
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+_START_OF_ZIP = object()
+_END_OF_ZIP = object()
+
+
+class PipelineAborted(Exception):
+    """
+    Raised inside a stage when another stage of the pipeline has failed.
+    """
+
+
+def run_europeana_pipeline(path_staging_area,
+                           url_ftp_host=FTP_HOST_EUROPEANA, until=None,
+                           n_connections=2, workers=None, chunksize=64,
+                           max_staged_zips=2, queue_size=1024,
+                           streaming=False, keep_zips=True, sink='jsonl',
+                           port=21, ftp_dir=FTP_DIR_EUROPEANA, manifest=None):
+    """
+    Download, transform and store the Europeana dump with the stages running
+    concurrently, so that zip N+1 is downloaded while zip N is transformed.
+
+    Downloads run on ``n_connections`` FTP connections, transformation runs in
+    this process or in a pool of ``workers`` processes, and storing runs in
+    the calling thread. The stages are joined by bounded queues: at most
+    ``max_staged_zips`` verified zips wait for the transform stage (plus one
+    per connection that is blocked handing its zip over) and at most
+    ``queue_size`` records wait to be stored. Unless ``keep_zips`` is set, a
+    zip is deleted as soon as all its records are transformed, which caps the
+    disk used by the staging area; worker processes hold on to it until they
+    start on the next zip. ``sink`` selects how the records are
+    stored below ``path_staging_area/jsons``, see ``sinks.SINKS``; the
+    records of every zip replace those an earlier run stored for it.
+
+    If a ``manifest.Manifest`` is given, only zips that are new or listed
+    with a different size or mtime than when they were last stored are
+    fetched, and every zip is marked as stored once all its records are
+    written. Without one, the output of earlier runs is dropped.
+    """
+    ftp = ftp_login(url_ftp_host, port, ftp_dir)
+    listing, checksums = list_remote_zips(ftp)
+    ftp.quit()
+    zips = [x for x, (size, mtime) in listing.items()
+            if manifest is None or not manifest.is_current(x, size, mtime)]
+    zips = zips[:until]
+
+    dir_zipped = os.path.join(path_staging_area, 'zipped')
+    dir_unzipped = os.path.join(path_staging_area, 'unzipped')
+    zip_queue = queue.Queue(maxsize=max_staged_zips)
+    record_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def on_downloaded(fpath, md5):
+        if manifest is not None:
+            manifest.mark_downloaded(os.path.basename(fpath),
+                                     *listing[os.path.basename(fpath)], md5)
+        __put(zip_queue, fpath, stop)
+
+    def download():
+        try:
+            download_zips(zips, dir_zipped, url_ftp_host, n_connections,
+                          port, ftp_dir, checksums=checksums,
+                          on_downloaded=on_downloaded)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            __put(zip_queue, _DONE, stop, force=True)
+
+    def transform_zips(executor):
+        try:
+            for _zip in __drain(zip_queue, stop):
+                sources = iter_zip_members(_zip, dir_unzipped)
+                __put(record_queue, (_START_OF_ZIP, _zip), stop)
+                for result in transform(sources, streaming, workers,
+                                        chunksize, executor):
+                    __put(record_queue, result, stop)
+                __put(record_queue, (_END_OF_ZIP, _zip), stop)
+                if not keep_zips:
+                    os.remove(_zip)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            __put(record_queue, _DONE, stop, force=True)
+
+    executor = None
+    if workers is not None and workers > 1:
+        # Threads are running once the pipeline starts; spawned workers do
+        # not inherit their locks the way forked ones would.
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    threads = [threading.Thread(target=download, name='download'),
+               threading.Thread(target=transform_zips, args=(executor,),
+                                name='transform')]
+    for thread in threads:
+        thread.start()
+    try:
+        with open_sink(sink, os.path.join(path_staging_area, 'jsons'),
+                       incremental=manifest is not None) as _sink, \
+                tqdm(desc="Transforming", unit='records') as progress:
+            locations = []
+            for fpath, item in __drain(record_queue, stop):
+                if fpath is _START_OF_ZIP:
+                    _sink.start_part(
+                        os.path.splitext(os.path.basename(item))[0])
+                elif fpath is _END_OF_ZIP:
+                    if manifest is not None:
+                        manifest.mark_stored(os.path.basename(item),
+                                             locations)
+                    locations = []
+                else:
+                    locations += store_files([(fpath, item)], _sink,
+                                             dir_unzipped, progress)
+    except BaseException as e:
+        if not isinstance(e, PipelineAborted):
+            errors.append(e)
+        stop.set()
+    finally:
+        for thread in threads:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(cancel_futures=bool(errors))
+    if errors:
+        raise errors[0]
+
+
+def __put(_queue, item, stop, force=False):
+    """
+    Put ``item`` on the bounded ``_queue``, waiting for space unless the
+    pipeline is being stopped. With ``force`` the item is always queued, so
+    that end-of-stream markers cannot get lost.
+    """
+    while True:
+        if stop.is_set() and not force:
+            raise PipelineAborted()
+        try:
+            _queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            if stop.is_set() and force:
+                __discard(_queue)
+
+
+def __drain(_queue, stop):
+    """
+    Yield items from ``_queue`` until the end-of-stream marker arrives.
+    """
+    while True:
+        try:
+            item = _queue.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                raise PipelineAborted()
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def __discard(_queue):
+    try:
+        _queue.get_nowait()
+    except queue.Empty:
+        pass
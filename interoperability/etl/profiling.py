@@ -0,0 +1,108 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+
+PROFILERS = ('sampling', 'cprofile')
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads of this process every ``interval``
+    seconds from a background thread and writes them in the collapsed stack
+    format, one ``thread;outer;...;inner count`` line per distinct stack,
+    as read by ``flamegraph.pl``, speedscope or inferno. Unlike cProfile it
+    costs next to nothing in the profiled code and sees every thread, e.g.
+    the publish and description fetching pools. Worker processes are not
+    sampled.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.__run, name='profiler',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def __run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_label(frame.f_code))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(frames))] += 1
+            self.samples += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _label(code):
+    filename = os.path.basename(code.co_filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(
+        ';', ',')
+
+
+@contextmanager
+def profiled(path, profiler='sampling', interval=0.005):
+    """
+    Profile the block and write the result to ``path`` when it is left,
+    also if it raises. The ``sampling`` profiler writes collapsed stacks
+    for a flame graph, see ``SamplingProfiler``; ``cprofile`` writes
+    ``pstats`` data of the calling thread for snakeviz, flameprof or
+    ``python -m pstats``.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f'Unknown profiler {profiler!r}, use one of '
+                         f'{", ".join(PROFILERS)}')
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+    else:
+        profile = SamplingProfiler(interval).start()
+    try:
+        yield profile
+    finally:
+        if profiler == 'cprofile':
+            profile.disable()
+            profile.dump_stats(path)
+        else:
+            profile.stop()
+            profile.write(path)
+        print(f'Profiled {time.perf_counter() - started:.1f}s with '
+              f'{profiler}, written to {path}', file=sys.stderr)
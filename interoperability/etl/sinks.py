@@ -0,0 +1,373 @@
+import glob
+import gzip
+import json
+import os
+
+from collections import defaultdict
+
+from etl.catalogue import CATALOGUE_NAME, Catalogue
+
+
+class Sink:
+    """
+    Base class of the store stage. ``write(key, data_dict)`` stores one TRUSTS
+    data_dict and returns the location it was stored at; ``close()`` flushes
+    whatever is still buffered. ``ensure_ascii`` is passed on to the json
+    encoder by the sinks that write JSON.
+
+    ``start_part(name)`` begins a part, e.g. the records of one zip, that
+    replaces what an earlier run stored as the same part. Unless
+    ``incremental`` is set, a sink also drops everything earlier runs stored
+    in ``dir_out``, so that a rerun never adds to it.
+    """
+
+    def __init__(self, dir_out, ensure_ascii=True, incremental=False):
+        self.dir_out = dir_out
+        self.ensure_ascii = ensure_ascii
+        self.incremental = incremental
+
+    def write(self, key, data_dict):
+        raise NotImplementedError
+
+    def start_part(self, name):
+        pass
+
+    def write_frame(self, frame, key_column):
+        """
+        Store every row of a pandas DataFrame whose dotted columns, e.g.
+        ``resources.url``, stand for nested keys, keyed by ``key_column``,
+        and return the locations. Rows only become dicts here.
+        """
+        return [self.write(key, data_dict) for key, data_dict
+                in zip(frame[key_column], frame_records(frame))]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JsonFilesSink(Sink):
+    """
+    Store every record as its own ``<dir_out>/<key>.json`` file. This is the
+    original layout of the ``jsons`` folder. A record stored again replaces
+    its file, and files of earlier runs are left alone.
+    """
+
+    def write(self, key, data_dict):
+        fpath = os.path.join(self.dir_out, f'{key}.json')
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'w', encoding='utf8') as f:
+            json.dump(data_dict, f, ensure_ascii=self.ensure_ascii)
+        return fpath
+
+
+class JsonLinesSink(Sink):
+    """
+    Store records as JSON Lines in size-rotated shards
+    ``<dir_out>/<prefix>-00000.jsonl[.gz]``, or
+    ``<prefix>-<part>-00000.jsonl[.gz]`` after ``start_part``. Records are
+    buffered and written ``batch_size`` at a time through a single open
+    handle per shard. A new shard is started after ``max_records`` records
+    or ``max_bytes`` uncompressed bytes, whichever comes first.
+    """
+
+    def __init__(self, dir_out, prefix='part', compress=True,
+                 max_records=100000, max_bytes=None, batch_size=1000,
+                 ensure_ascii=True, incremental=False):
+        super().__init__(dir_out, ensure_ascii, incremental)
+        self.prefix = prefix
+        self.compress = compress
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self._encoder = json.JSONEncoder(ensure_ascii=ensure_ascii)
+        self._buffer = []
+        self._file = None
+        self._part = None
+        self._shard = -1
+        self._shard_path = None
+        self._shard_records = 0
+        self._shard_bytes = 0
+        os.makedirs(dir_out, exist_ok=True)
+        _remove_shards(dir_out, prefix, ('.jsonl', '.jsonl.gz'),
+                       all_parts=not incremental)
+
+    def write(self, key, data_dict):
+        if self._file is None or self.__shard_is_full():
+            self.__rotate()
+        self._buffer.append(self._encoder.encode(data_dict))
+        line_no = self._shard_records
+        self._shard_records += 1
+        self._shard_bytes += len(self._buffer[-1]) + 1
+        if len(self._buffer) >= self.batch_size:
+            self.__flush()
+        return f'{self._shard_path}#{line_no}'
+
+    def start_part(self, name):
+        self.close()
+        self._part = name
+        self._shard = -1
+        _remove_shards(self.dir_out, self.prefix, ('.jsonl', '.jsonl.gz'),
+                       part=name)
+
+    def close(self):
+        if self._file is not None:
+            self.__flush()
+            self._file.close()
+            self._file = None
+
+    def __shard_is_full(self):
+        if self.max_records and self._shard_records >= self.max_records:
+            return True
+        return bool(self.max_bytes) and self._shard_bytes >= self.max_bytes
+
+    def __rotate(self):
+        self.close()
+        self._shard += 1
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        self._shard_path = os.path.join(
+            self.dir_out,
+            _shard_name(self.prefix, self._part, self._shard) + suffix)
+        if self.compress:
+            self._file = gzip.open(self._shard_path, 'wt', encoding='utf8',
+                                   compresslevel=5)
+        else:
+            self._file = open(self._shard_path, 'w', encoding='utf8')
+        self._shard_records = 0
+        self._shard_bytes = 0
+
+    def __flush(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+
+
+class ParquetSink(Sink):
+    """
+    Store records as Parquet shards ``<dir_out>/<prefix>-00000.parquet``,
+    or ``<prefix>-<part>-00000.parquet`` after ``start_part``, of up to
+    ``max_records`` rows each, written through pandas. Nested dicts such as
+    ``resources`` are flattened into dotted columns, e.g. ``resources.url``.
+    Needs ``pyarrow`` or ``fastparquet`` to be installed.
+    """
+
+    def __init__(self, dir_out, prefix='part', max_records=100000,
+                 compression='snappy', ensure_ascii=True, incremental=False):
+        super().__init__(dir_out, ensure_ascii, incremental)
+        self.prefix = prefix
+        self.max_records = max_records
+        self.compression = compression
+        self._rows = []
+        self._part = None
+        self._shard = 0
+        os.makedirs(dir_out, exist_ok=True)
+        _remove_shards(dir_out, prefix, ('.parquet',),
+                       all_parts=not incremental)
+
+    def write(self, key, data_dict):
+        location = f'{self.__shard_path()}#{len(self._rows)}'
+        self._rows.append(data_dict)
+        if len(self._rows) >= self.max_records:
+            self.__flush()
+        return location
+
+    def write_frame(self, frame, key_column):
+        """
+        Store the DataFrame as it is; its dotted columns already are the
+        flattened layout of ``write``.
+        """
+        self.__flush()
+        locations = []
+        for start in range(0, len(frame), self.max_records):
+            shard = frame.iloc[start:start + self.max_records]
+            shard.to_parquet(self.__shard_path(),
+                             compression=self.compression, index=False)
+            locations += [f'{self.__shard_path()}#{i}'
+                          for i in range(len(shard))]
+            self._shard += 1
+        return locations
+
+    def start_part(self, name):
+        self.__flush()
+        self._part = name
+        self._shard = 0
+        _remove_shards(self.dir_out, self.prefix, ('.parquet',), part=name)
+
+    def close(self):
+        self.__flush()
+
+    def __shard_path(self):
+        return os.path.join(
+            self.dir_out,
+            _shard_name(self.prefix, self._part, self._shard) + '.parquet')
+
+    def __flush(self):
+        if not self._rows:
+            return
+        # pandas is only needed here and is slow to import in every worker
+        import pandas as pd
+        pd.json_normalize(self._rows).to_parquet(
+            self.__shard_path(), compression=self.compression, index=False)
+        self._rows = []
+        self._shard += 1
+
+
+class CatalogueSink(Sink):
+    """
+    Store records in a ``catalogue.Catalogue`` at
+    ``<dir_out>/catalogue.sqlite``, indexed for lookups by key, remoteId,
+    europeana_id, owner_org, name and full text, ``batch_size`` records per
+    transaction. A record stored again replaces the one under its key.
+    """
+
+    def __init__(self, dir_out, batch_size=1000, ensure_ascii=True,
+                 incremental=False):
+        super().__init__(dir_out, ensure_ascii, incremental)
+        self.batch_size = batch_size
+        os.makedirs(dir_out, exist_ok=True)
+        self.catalogue = Catalogue(os.path.join(dir_out, CATALOGUE_NAME))
+        if not incremental:
+            self.catalogue.clear()
+        self._buffer = []
+
+    def write(self, key, data_dict):
+        self._buffer.append((key, data_dict))
+        if len(self._buffer) >= self.batch_size:
+            self.__flush()
+        return f'{self.catalogue.db_path}#{key}'
+
+    def close(self):
+        self.__flush()
+        self.catalogue.close()
+
+    def __flush(self):
+        if self._buffer:
+            self.catalogue.add(self._buffer)
+            self._buffer = []
+
+
+def _shard_name(prefix, part, shard):
+    """
+    >>> _shard_name('part', None, 3), _shard_name('part', '2021_a', 3)
+    ('part-00003', 'part-2021_a-00003')
+    """
+    if part is None:
+        return f'{prefix}-{shard:05d}'
+    return f'{prefix}-{part}-{shard:05d}'
+
+
+def _remove_shards(dir_out, prefix, suffixes, part=None, all_parts=False):
+    """
+    Remove the shards with one of ``suffixes`` that earlier runs wrote to
+    ``dir_out`` for ``part``, or for any part if ``all_parts`` is set.
+    """
+    for fname in os.listdir(dir_out):
+        stem = next((fname[:-len(suffix)] for suffix in suffixes
+                     if fname.endswith(suffix)), None)
+        if stem is None or not stem.startswith(prefix + '-'):
+            continue
+        # Shards written before any start_part have no part name
+        name, _, number = stem[len(prefix) + 1:].rpartition('-')
+        if len(number) != 5 or not number.isdigit():
+            continue
+        if all_parts or (name or None) == part:
+            os.remove(os.path.join(dir_out, fname))
+
+
+def frame_records(frame):
+    """
+    Yield the rows of a pandas DataFrame as dicts, nesting dotted columns
+    such as ``resources.url`` and turning missing values into ``None``.
+    """
+    paths = [column.split('.') for column in frame.columns]
+    for row in frame.itertuples(index=False, name=None):
+        record = {}
+        for path, value in zip(paths, row):
+            target = record
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = None if _is_missing(value) else value
+        yield record
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def read_records(dir_out, locations=None):
+    """
+    Yield the data_dicts stored below ``dir_out`` by a ``JsonFilesSink``,
+    ``JsonLinesSink`` or ``CatalogueSink``, shard by shard. With
+    ``locations`` as returned by the sinks, e.g. those a
+    ``manifest.Manifest`` lists as current, only the records stored there are
+    read, and no other file below ``dir_out`` is looked at.
+    """
+    if locations is not None:
+        yield from _read_locations(locations)
+        return
+    for fpath in sorted(glob.glob(os.path.join(glob.escape(dir_out), '**',
+                                               CATALOGUE_NAME),
+                                  recursive=True)):
+        with Catalogue(fpath) as catalogue:
+            for _, data_dict in catalogue.records():
+                yield data_dict
+    for fpath in sorted(glob.glob(os.path.join(glob.escape(dir_out), '**',
+                                               '*.json*'), recursive=True)):
+        if fpath.endswith('.json'):
+            with open(fpath, encoding='utf8') as f:
+                yield json.load(f)
+        elif fpath.endswith(('.jsonl', '.jsonl.gz')):
+            _open = gzip.open if fpath.endswith('.gz') else open
+            with _open(fpath, 'rt', encoding='utf8') as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def _read_locations(locations):
+    """
+    Yield the data_dicts stored at ``locations``, reading every shard or
+    catalogue only once.
+    """
+    positions = defaultdict(set)
+    for location in locations:
+        if location.endswith('.json'):
+            positions[location] = None
+        else:
+            fpath, _, position = location.rpartition('#')
+            positions[fpath].add(position)
+    for fpath in sorted(positions):
+        if positions[fpath] is None:
+            with open(fpath, encoding='utf8') as f:
+                yield json.load(f)
+        elif fpath.endswith(CATALOGUE_NAME):
+            with Catalogue(fpath) as catalogue:
+                for _, data_dict in catalogue.records(positions[fpath]):
+                    yield data_dict
+        else:
+            lines = {int(position) for position in positions[fpath]}
+            _open = gzip.open if fpath.endswith('.gz') else open
+            with _open(fpath, 'rt', encoding='utf8') as f:
+                for line_no, line in enumerate(f):
+                    if line_no in lines:
+                        yield json.loads(line)
+
+
+SINKS = {
+    'files': JsonFilesSink,
+    'jsonl': JsonLinesSink,
+    'parquet': ParquetSink,
+    'catalogue': CatalogueSink,
+}
+
+
+def open_sink(kind, dir_out, **kwargs):
+    """
+    Create the sink registered as ``kind`` in ``SINKS``, writing below
+    ``dir_out``.
+    """
+    return SINKS[kind](dir_out, **kwargs)
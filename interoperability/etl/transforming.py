@@ -1,114 +1,376 @@
 import glob
-import json
+import multiprocessing
 import os
+import queue
+import zipfile
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from lxml import etree
+from toolz.itertoolz import partition_all
 from tqdm import tqdm
 
+from etl.edm import RDF_RECORD_TAG, EuropeanaRecordExtractor
+from etl.metrics import metrics
+from etl.sinks import open_sink
 
-EUROPEANA_DATA_DICT_MAPPING = {
-    'name': 'string(edm:EuropeanaAggregation/edm:datasetName)',
-    'title': 'string(ore:Proxy/dc:title)',
-    'notes': 'string(ore:Proxy/dc:description)',
-}
 
-EUROPEANA_RESOURCES_MAPPING = {
-    'created': 'string(dqv:QualityAnnotation/dcterms:created)',
-    'dataProvider': 'string(ore:Aggregation/edm:rights)',
-    'name': 'string(edm:EuropeanaAggregation/edm:datasetName)',
-    'remoteId': 'string(ore:Proxy/dc:identifier)',
-    # 'remoteId': 'string(ore:Proxy/dc:identifier)',
-    'rights': 'string(ore:Aggregation/edm:rights)',
-    'url': 'string(edm:WebResource/@rdf:about)',
-}
+_RECORD_EXTRACTOR = EuropeanaRecordExtractor()
 
+# The zip a worker process keeps open between chunks, see __worker_zipfile
+_WORKER_ZIPS = {}
+# Batches of streamed records a worker may put ahead of the consumer
+_STREAMED_BATCHES = 4
 
-def main(path_staging_area):
+
+def main(path_staging_area, streaming=False, from_zips=False, workers=None,
+         chunksize=64, sink='jsonl', manifest=None, limit=None):
+    """
+    Transform all .xml files below ``path_staging_area/unzipped``. With
+    ``streaming`` each file may hold any number of ``rdf:RDF`` records, which
+    are read one at a time with ``iterparse`` so that memory stays flat. With
+    ``from_zips`` the records are read straight from the archives in
+    ``path_staging_area/zipped`` and nothing needs to be extracted to disk.
+    With ``workers`` > 1 the files are transformed by a pool of processes,
+    ``chunksize`` files at a time, and with ``streaming`` the records come
+    back ``chunksize`` at a time; the output order stays the same. ``sink``
+    selects how the records are stored below ``path_staging_area/jsons``,
+    see ``sinks.SINKS``; the records of every zip replace those an earlier
+    run stored for it. If a ``manifest.Manifest`` is given, zips it lists as
+    stored are skipped and what is stored for them is kept, and every zip is
+    marked as stored together with the locations of its records once it is
+    done. Without one, the output of earlier runs is dropped. ``limit`` caps the number of
+    zips transformed in this run.
+    """
     dir_unzipped = os.path.join(path_staging_area, 'unzipped')
-    pathname = dir_unzipped + '/**/*.xml'
-    gen_transform = __transform(pathname)
-    __store_files(gen_transform)
+    if from_zips:
+        zip_glob = os.path.join(path_staging_area, 'zipped', '*.zip')
+        zips = [(os.path.splitext(os.path.basename(_zip))[0],
+                 partial(iter_zip_members, _zip, dir_unzipped))
+                for _zip in sorted(glob.glob(zip_glob))]
+    else:
+        zips = [(zip_name,
+                 partial(__iter_xml_files,
+                         os.path.join(glob.escape(dir_unzipped),
+                                      glob.escape(zip_name), '**', '*.xml')))
+                for zip_name in sorted(os.listdir(dir_unzipped))]
+    if manifest is not None:
+        zips = [(zip_name, sources) for zip_name, sources in zips
+                if not manifest.is_current(zip_name)]
+    zips = zips[:limit]
+
+    executor = None
+    if workers is not None and workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        with open_sink(sink, os.path.join(path_staging_area, 'jsons'),
+                       incremental=manifest is not None) as _sink, \
+                tqdm(desc="Transforming", unit='records') as progress:
+            for zip_name, sources in zips:
+                _sink.start_part(zip_name)
+                gen_transform = transform(sources(), streaming, workers,
+                                          chunksize, executor)
+                locations = store_files(gen_transform, _sink, dir_unzipped,
+                                        progress)
+                if manifest is not None:
+                    manifest.mark_stored(zip_name, locations)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
-def __transform(f_glob):
+def transform(sources, streaming=False, workers=None, chunksize=64,
+              executor=None):
     """
-    Iterate over a folder containing Europeana .xml files and transform them
-    into TRUSTS data_dicts.
+    Transform the ``(fpath, locator)`` pairs produced by ``__iter_xml_files``
+    or ``iter_zip_members`` into ``(fpath, data_dict)`` pairs, either in this
+    process or, if ``workers`` > 1, in a pool of worker processes. A running
+    ``ProcessPoolExecutor`` with ``workers`` processes can be passed as
+    ``executor`` to share one pool across many calls.
     """
-    for xml_file in tqdm(glob.glob(f_glob), desc="Transforming"):
-        yield (xml_file, __transform_single_xml_file(xml_file))
+    if executor is not None:
+        yield from __transform_parallel(sources, streaming, executor,
+                                        workers or os.cpu_count(), chunksize)
+    elif workers is None or workers <= 1:
+        transform_source = (__transform_source_streaming if streaming
+                            else __transform_source)
+        with __zipfiles() as open_zipfile:
+            for fpath, locator in sources:
+                yield from transform_source(fpath, locator, open_zipfile)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from __transform_parallel(sources, streaming, executor,
+                                            workers, chunksize)
 
 
-def __transform_single_xml_file(xml_file):
+def __transform_parallel(sources, streaming, executor, workers, chunksize):
     """
-    Turn a Europeana xml file into a TRUSTS version. This function filters out
-    xml properties that are not represented in TRUSTS.
+    Hand out ``sources`` in chunks of ``chunksize`` to a pool of ``workers``
+    processes. At most a few chunks per worker are in flight at any time and
+    results are yielded in submission order, so the output is deterministic
+    and the source listing is never materialised as a whole.
+
+    With ``streaming`` the workers read the files of their chunk one record
+    at a time and send the results back ``chunksize`` records at a time, each
+    chunk through a queue of its own that holds only a few of them. A file
+    with many records therefore never ends up in a single result, and a
+    worker that gets ahead of the consumer waits instead of filling memory.
+    """
+    max_in_flight = 4 * workers
+    in_flight = deque()
+    if streaming:
+        with multiprocessing.Manager() as manager:
+            for chunk in partition_all(chunksize, sources):
+                results = manager.Queue(maxsize=_STREAMED_BATCHES)
+                in_flight.append((executor.submit(
+                    __transform_chunk_streaming, chunk, chunksize, results),
+                    results))
+                if len(in_flight) >= max_in_flight:
+                    yield from __receive_batches(*in_flight.popleft())
+            while in_flight:
+                yield from __receive_batches(*in_flight.popleft())
+        return
+    for chunk in partition_all(chunksize, sources):
+        in_flight.append(executor.submit(__transform_chunk, chunk))
+        if len(in_flight) >= max_in_flight:
+            yield from in_flight.popleft().result()
+    while in_flight:
+        yield from in_flight.popleft().result()
+
+
+def __transform_chunk(chunk):
+    """
+    Transform a chunk of ``(fpath, locator)`` pairs of single-record files
+    inside a worker process.
+    """
+    return [result
+            for fpath, locator in chunk
+            for result in __transform_source(fpath, locator,
+                                             __worker_zipfile)]
+
+
+def __transform_chunk_streaming(chunk, batch_size, results):
+    """
+    Stream the records of a chunk of ``(fpath, locator)`` pairs inside a
+    worker process and put them on the queue ``results`` in lists of up to
+    ``batch_size``, followed by ``None`` once the chunk is done.
+    """
+    try:
+        records = (result
+                   for fpath, locator in chunk
+                   for result in __transform_source_streaming(
+                       fpath, locator, __worker_zipfile))
+        for batch in partition_all(batch_size, records):
+            results.put(list(batch))
+    finally:
+        results.put(None)
+
+
+def __receive_batches(future, results):
+    """
+    Yield the records ``__transform_chunk_streaming`` puts on ``results``
+    until the chunk is done, and raise what the worker raised, also if it
+    died before it could say so.
     """
-    data_dict = __extract_data_dict(xml_file)
-    data_dict.update({'owner_org': 'Europeana'})
-    data_dict.update({'resources': __extract_resources(xml_file)})
-    if 'resources' not in data_dict:
-        data_dict['resources'] = __extract_europeana_id(xml_file)
+    while True:
+        try:
+            batch = results.get(timeout=1)
+        except queue.Empty:
+            if future.done() and future.exception() is not None:
+                future.result()
+            continue
+        if batch is None:
+            future.result()
+            return
+        yield from batch
+
+
+def __worker_zipfile(_zip):
+    """
+    Open ``_zip`` once per worker process rather than once per chunk, as
+    reading the central directory of a zip with many members costs far more
+    than transforming a chunk of them. A worker keeps only the zip it is
+    working on open: it closes the previous one as soon as it gets a chunk of
+    another zip, or of a new file at the same path. A zip deleted once it is
+    transformed is therefore released by the time the next one is.
+    """
+    stat = os.stat(_zip)
+    key = (_zip, stat.st_ino, stat.st_mtime_ns)
+    if key not in _WORKER_ZIPS:
+        for zip_ref in _WORKER_ZIPS.values():
+            zip_ref.close()
+        _WORKER_ZIPS.clear()
+        _WORKER_ZIPS[key] = zipfile.ZipFile(_zip, 'r')
+    return _WORKER_ZIPS[key]
+
+
+def __iter_xml_files(f_glob):
+    """
+    Yield ``(fpath, locator)`` for every .xml file matching ``f_glob``. The
+    locator of a plain file is its path.
+    """
+    for xml_file in glob.glob(f_glob, recursive=True):
+        yield xml_file, xml_file
+
+
+def iter_zip_members(_zip, dir_unzipped):
+    """
+    Yield ``(fpath, locator)`` for every .xml member of the zip file
+    ``_zip``. The locator is a ``(zip path, member name)`` tuple and ``fpath``
+    is the path the member would have been extracted to by
+    ``extracting.__unzip``, so the stored .json files end up in the same
+    place either way.
+    """
+    zip_name = os.path.splitext(os.path.basename(_zip))[0]
+    with zipfile.ZipFile(_zip, 'r') as zip_ref:
+        members = [member.filename for member in zip_ref.infolist()
+                   if not member.is_dir()
+                   and member.filename.endswith('.xml')]
+    for member in members:
+        yield os.path.join(dir_unzipped, zip_name, member), (_zip, member)
+
+
+@contextmanager
+def __open_source(locator, open_zipfile):
+    """
+    Open the file or zip member described by ``locator`` for reading, zip
+    members through ``open_zipfile``, see ``__zipfiles``.
+    """
+    if isinstance(locator, tuple):
+        _zip, member = locator
+        with open_zipfile(_zip).open(member) as source:
+            yield source
     else:
-        data_dict['resources'].update({'europeana_id':
-                                       __extract_europeana_id(xml_file)})
-    return data_dict
+        with open(locator, 'rb') as source:
+            yield source
 
 
-def __extract_data_dict(fpath):
+@contextmanager
+def __zipfiles():
     """
-    Convert a Europeana xml file to a TRUSTS data dictionary.
+    A function opening zip files on demand, each only once, so that the
+    central directory is not re-read for every member. The zip files are
+    closed when the block is left, e.g. at the end of a zip, so
+    that a zip deleted after it was transformed really frees its space.
     """
-    tree = etree.parse(fpath)
-    return {key: __get_value_from_xpath(xpath, tree)
-            for key, xpath in EUROPEANA_DATA_DICT_MAPPING.items()}
+    zips = {}
 
+    def open_zipfile(_zip):
+        if _zip not in zips:
+            zips[_zip] = zipfile.ZipFile(_zip, 'r')
+        return zips[_zip]
 
-def __extract_europeana_id(fname):
+    try:
+        yield open_zipfile
+    finally:
+        for zip_ref in zips.values():
+            zip_ref.close()
+
+
+def __transform_source(fpath, locator, open_zipfile):
     """
-    Read the Europeana ID from the file name.
+    Transform a single-record file into ``[(fpath, data_dict)]``.
+    """
+    with __open_source(locator, open_zipfile) as source:
+        return [(fpath, __transform_single_xml_file(fpath, source))]
 
-    >>> fname = 'path/to/file/europeana_id.xml'
-    >>> extract_europeana_id(fname)
-    'europeana_id'
+
+def __transform_source_streaming(fpath, locator, open_zipfile):
     """
-    fname = os.path.splitext(fname)[0]
-    return os.path.split(fname)[1]
+    Yield one ``(fpath, data_dict)`` per ``rdf:RDF`` record in the file, so
+    that exports bundling many records into one file are never held in memory
+    as a whole.
+    """
+    dir_records = os.path.splitext(fpath)[0]
+    with __open_source(locator, open_zipfile) as source:
+        for europeana_id, data_dict in __transform_multi_record_file(source):
+            yield os.path.join(dir_records, f'{europeana_id}.xml'), data_dict
 
 
-def __extract_resources(fname):
+def __transform_multi_record_file(source):
     """
-    Extract the resources, i.e. links to images, etc., from the XML tree
+    Yield ``(europeana_id, data_dict)`` for every ``rdf:RDF`` record in
+    ``source``. Records without an ``edm:ProvidedCHO`` are numbered by their
+    position in the file.
     """
-    tree = etree.parse(fname)
-    return {key: __get_value_from_xpath(xpath, tree)
-            for key, xpath in EUROPEANA_RESOURCES_MAPPING.items()}
+    for i, record in enumerate(__iter_records(source)):
+        yield __map_record(record, i)
 
 
-def __get_value_from_xpath(xpath, tree):
+def __map_record(record, i):
     """
-    Extract the value of the given xpath from the tree, using the nsmap of the
-    tree's root element as the namespace.
+    ``(europeana_id, data_dict)`` of the ``rdf:RDF`` element ``record``, the
+    ``i``-th of its file.
     """
-    return tree.xpath(xpath, namespaces=tree.getroot().nsmap)
+    with metrics.timer('map'):
+        europeana_id = _RECORD_EXTRACTOR.record_id(record) or str(i)
+        data_dict = _RECORD_EXTRACTOR.from_element(record, europeana_id)
+    metrics.count('map')
+    return europeana_id, data_dict
 
 
-def __create_json_dir(base_folder):
+def __iter_records(source):
     """
-    Creates the folder structure needed to hold zipped and unzipped data and
-    the extracted .json files.
+    Stream the ``rdf:RDF`` elements of ``source``. Every record is cleared
+    once the caller is done with it and already processed siblings are
+    detached from the root, so the partial tree never grows.
     """
-    dir_jsons = os.path.join(base_folder, 'jsons')
-    if not os.path.exists(dir_jsons):
-        os.makedirs(dir_jsons)
+    context = etree.iterparse(source, events=('end',), tag=RDF_RECORD_TAG,
+                              huge_tree=True)
+    for _, record in context:
+        yield record
+        record.clear()
+        parent = record.getparent()
+        if parent is not None:
+            while record.getprevious() is not None:
+                del parent[0]
+    del context
+
+
+def __transform_single_xml_file(xml_file, source=None):
+    """
+    Turn a Europeana xml file into a TRUSTS version. This function filters out
+    xml properties that are not represented in TRUSTS. ``source`` may be given
+    to read the content from somewhere other than ``xml_file``, e.g. from an
+    open zip member.
+    """
+    with metrics.timer('parse'):
+        record = etree.parse(source or xml_file).getroot()
+    metrics.count('parse')
+    with metrics.timer('map'):
+        data_dict = _RECORD_EXTRACTOR.from_element(
+            record, __extract_europeana_id(xml_file))
+    metrics.count('map')
+    return data_dict
+
+
+def __extract_europeana_id(fname):
+    """
+    Read the Europeana ID from the file name.
+
+    >>> fname = 'path/to/file/europeana_id.xml'
+    >>> extract_europeana_id(fname)
+    'europeana_id'
+    """
+    fname = os.path.splitext(fname)[0]
+    return os.path.split(fname)[1]
 
 
-def __store_files(gen_transform):
+def store_files(gen_transform, sink, dir_unzipped, progress=None):
     """
+    Write the ``(fpath, data_dict)`` pairs to ``sink``, keyed by the path of
+    the source file relative to ``dir_unzipped`` without its extension, and
+    return the ``(key, location)`` of every stored record. ``progress`` is an
+    optional tqdm bar that is advanced per record.
     """
+    locations = []
     for fpath, data_dict in gen_transform:
-        fpath = fpath.replace('unzipped', 'jsons')
-        fpath = fpath.replace('xml', 'json')
-        os.makedirs(os.path.dirname(fpath), exist_ok=True)
-        with open(os.path.join(fpath), 'w') as f:
-            json.dump(data_dict, f)
+        key = os.path.splitext(os.path.relpath(fpath, dir_unzipped))[0]
+        with metrics.timer('store'):
+            locations.append((key, sink.write(key, data_dict)))
+        metrics.count('store')
+        if progress is not None:
+            progress.update()
+    return locations
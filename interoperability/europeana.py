@@ -1,20 +1,28 @@
 import argparse
-import json
 import os
 import zipfile
 
 from ftplib import FTP
-from lxml import etree
 from tqdm import tqdm
 
+from etl.edm import EuropeanaRecordExtractor
+from etl.manifest import Manifest
+from etl.metrics import metrics
+from etl.pipeline import run_europeana_pipeline
+from etl.sinks import SINKS, open_sink
 from europeana_config import (EUROPEANA_DATA_DICT_MAPPING,
                               EUROPEANA_RESOURCES_MAPPING, FTP_HOST_EUROPEANA)
 
 
-def europeana_file_iterable(path_to_dataset, until):
+_RECORD_EXTRACTOR = EuropeanaRecordExtractor(EUROPEANA_DATA_DICT_MAPPING,
+                                             EUROPEANA_RESOURCES_MAPPING)
+
+
+def europeana_file_iterable(path_to_dataset, until, sink='jsonl'):
     """
     Iterate over the zipped files in ``path_to_dataset`` until ``until`` is
-    reached, unzip them, and extract the relevant properties as json files.
+    reached, unzip them, and extract the relevant properties as json files,
+    stored through the ``sink`` selected from ``etl.sinks.SINKS``.
     """
     ftp, zips = __get_list_of_zips_on_ftp()
     for _zip in zips[:until]:
@@ -24,10 +32,19 @@ def europeana_file_iterable(path_to_dataset, until):
                                                                zip_name)
 
         # Run the process
-        __download_zipfile(ftp, dir_zipped, _zip)
-        __unzip(dir_unzipped, os.path.join(dir_zipped, _zip))
-        data_dicts = __transform(dir_unzipped)
-        __store_files(data_dicts, dir_jsons)
+        with metrics.timer('download'):
+            __download_zipfile(ftp, dir_zipped, _zip)
+        metrics.count('download')
+        metrics.add_bytes('download',
+                          os.path.getsize(os.path.join(dir_zipped, _zip)))
+        with metrics.timer('unzip'):
+            __unzip(dir_unzipped, os.path.join(dir_zipped, _zip))
+        with metrics.timer('transform'):
+            data_dicts = __transform(dir_unzipped)
+        metrics.count('transform', len(data_dicts))
+        with metrics.timer('store'):
+            __store_files(data_dicts, dir_jsons, sink)
+        metrics.count('store', len(data_dicts))
 
 
 def __get_list_of_zips_on_ftp():
@@ -90,24 +107,8 @@ def __transform_single_xml_file(xml_file):
     Turn a Europeana xml file into a TRUSTS version. This function filters out
     xml properties that are not represented in TRUSTS.
     """
-    data_dict = __extract_data_dict(xml_file)
-    data_dict.update({'owner_org': 'Europeana'})
-    data_dict.update({'resources': __extract_resources(xml_file)})
-    if 'resources' not in data_dict:
-        data_dict['resources'] = __extract_europeana_id(xml_file)
-    else:
-        data_dict['resources'].update({'europeana_id':
-                                       __extract_europeana_id(xml_file)})
-    return data_dict
-
-
-def __extract_data_dict(fpath):
-    """
-    Convert a Europeana xml file to a TRUSTS data dictionary.
-    """
-    tree = etree.parse(fpath)
-    return {key: __get_value_from_xpath(xpath, tree)
-            for key, xpath in EUROPEANA_DATA_DICT_MAPPING.items()}
+    return _RECORD_EXTRACTOR.from_file(xml_file,
+                                       __extract_europeana_id(xml_file))
 
 
 def __extract_europeana_id(fname):
@@ -122,30 +123,37 @@ def __extract_europeana_id(fname):
     return os.path.split(fname)[1]
 
 
-def __extract_resources(fname):
-    """
-    Extract the resources, i.e. links to images, etc., from the XML tree
-    """
-    tree = etree.parse(fname)
-    return {key: __get_value_from_xpath(xpath, tree)
-            for key, xpath in EUROPEANA_RESOURCES_MAPPING.items()}
-
-
-def __get_value_from_xpath(xpath, tree):
+def __store_files(data_dicts, dir_jsons, sink):
     """
-    Extract the value of the given xpath from the tree, using the nsmap of the
-    tree's root element as the namespace.
     """
-    return tree.xpath(xpath, namespaces=tree.getroot().nsmap)
+    with open_sink(sink, dir_jsons) as _sink:
+        for data_dict in data_dicts:
+            _sink.write(data_dict['resources']['europeana_id'], data_dict)
 
 
-def __store_files(data_dicts, dir_jsons):
+def main(base_folder, until=None, pipeline=False, workers=None,
+         sink='jsonl', incremental=False, metrics_dir=None):
     """
+    Acquire the first ``until`` zips from Europeana below ``base_folder``,
+    one after the other, or with ``pipeline`` overlapping downloading,
+    transforming and storing, see ``etl.pipeline.run_europeana_pipeline``.
+    ``incremental`` runs keep a manifest, which only the pipeline does.
     """
-    for data_dict in data_dicts:
-        fname = data_dict['resources']['europeana_id']
-        with open(os.path.join(dir_jsons, f'{fname}.json'), 'w') as f:
-            json.dump(data_dict, f)
+    if incremental and not pipeline:
+        raise ValueError("incremental runs need the pipeline")
+    if metrics_dir is not None:
+        metrics.enable()
+    if pipeline:
+        manifest = None
+        if incremental:
+            manifest = Manifest(os.path.join(base_folder, 'manifest.sqlite'))
+        run_europeana_pipeline(base_folder, FTP_HOST_EUROPEANA,
+                               until=until, workers=workers,
+                               sink=sink, manifest=manifest)
+    else:
+        europeana_file_iterable(base_folder, until, sink)
+    if metrics_dir is not None:
+        metrics.write(metrics_dir)
 
 
 if __name__ == '__main__':
@@ -162,5 +170,28 @@ if __name__ == '__main__':
         '-u', '--until', type=int,
         help='The number of zip files acquired from Europeana.'
     )
+    parser.add_argument(
+        '-p', '--pipeline', action='store_true',
+        help='Overlap downloading, transforming and storing.'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='The number of transform processes used with --pipeline.'
+    )
+    parser.add_argument(
+        '-s', '--sink', choices=sorted(SINKS), default='jsonl',
+        help='How the transformed records are stored.'
+    )
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Skip zips that are unchanged since the last --pipeline run.'
+    )
+    parser.add_argument(
+        '-m', '--metrics',
+        help='Write per-stage metrics.json and metrics.prom to this folder.'
+    )
     args = parser.parse_args()
-    europeana_file_iterable(args.base_folder, args.until)
+    if args.incremental and not args.pipeline:
+        parser.error('-i/--incremental only works with -p/--pipeline')
+    main(args.base_folder, args.until, args.pipeline, args.workers,
+         args.sink, args.incremental, args.metrics or None)
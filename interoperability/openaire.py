@@ -2,11 +2,27 @@ import doctest
 import glob
 import gzip
 import json
-import os
+import multiprocessing
+import traceback
 
+from itertools import islice
 from toolz.dicttoolz import get_in
 import toolz
 
+from etl.metrics import metrics
+from etl.sinks import open_sink
+
+try:
+    import orjson
+    JSON_LOADS = orjson.loads
+except ImportError:
+    JSON_LOADS = json.loads
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 
 OPENAIRE_TO_TRUSTS_MAPPING = {
     'description': 'notes',
@@ -15,42 +31,346 @@ OPENAIRE_TO_TRUSTS_MAPPING = {
     'maintitle': 'title',
 }
 
+# The only parts of an OpenAIRE record read by ``__map_openaire_to_trusts``
+OPENAIRE_REQUIRED_PATHS = [
+    ('description',),
+    ('id',),
+    ('instance', 0, 'license'),
+    ('instance', 0, 'url'),
+    ('maintitle',),
+    ('publicationdate',),
+    ('publisher',),
+]
 
-def main():
-    read_path = ('path/to/file'
-                 'dataset')
-    store_path = ('path/to/file'
-                  'dataset_trusts_metadata')
+# The top-level columns read by ``__map_openaire_frame``
+OPENAIRE_FRAME_COLUMNS = sorted({path[0] for path in OPENAIRE_REQUIRED_PATHS})
 
-    if not os.path.exists(store_path):
-        os.makedirs(store_path)
-    for i, json_dict in enumerate(openaire_file_iterable(read_path)):
-        fname = json_dict['resources']['remoteId']
-        with open(os.path.join(store_path, f"{fname}.json"), 'w',
-                  encoding='utf8') as f:
-            json.dump(json_dict, f, ensure_ascii=False)
-        if i == 199:
-            break
 
+class ProjectedLoads:
+    """
+    Decode only the given key ``paths`` of a json line and return them in a
+    dict of the same shape as the full record, e.g. ``('instance', 0, 'url')``
+    ends up in ``{'instance': [{'url': ...}]}``. Paths missing from a record
+    are left out, but the containers on the way that the record does have
+    are kept, so that ``{'instance': [{}]}`` stays an instance without a url
+    instead of becoming a record without instances.
 
-def openaire_file_iterable(path_to_dataset='.'):
+    With pysimdjson installed the line is parsed lazily and only the
+    projected values are turned into Python objects, so large unused fields
+    such as author lists are never allocated. Otherwise the line is decoded
+    with ``loads`` and the projection is taken from the result, which at
+    least keeps the unused fields from living on in batches.
+    """
+
+    def __init__(self, paths=OPENAIRE_REQUIRED_PATHS, loads=None):
+        self.paths = [tuple(path) for path in paths]
+        self.pointers = [_pointer(path) for path in self.paths]
+        self.loads = loads or JSON_LOADS
+        self._parser = None
+
+    def __call__(self, line):
+        if simdjson is None:
+            return self.__project_decoded(self.loads(line))
+        if self._parser is None:
+            self._parser = simdjson.Parser()
+        document = self._parser.parse(line)
+        projected = {}
+        for path, pointer in zip(self.paths, self.pointers):
+            try:
+                value = document.at_pointer(pointer)
+            except LookupError:
+                for k in range(len(path) - 1, 0, -1):
+                    try:
+                        parent = document.at_pointer(_pointer(path[:k]))
+                    except LookupError:
+                        continue
+                    if isinstance(parent, (simdjson.Object, simdjson.Array)):
+                        _assign_in(projected, path[:k],
+                                   {} if isinstance(parent, simdjson.Object)
+                                   else [], replace=False)
+                    break
+                continue
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            _assign_in(projected, path, value)
+        return projected
+
+    def __getstate__(self):
+        # simdjson parsers cannot be pickled; every process makes its own
+        return dict(self.__dict__, _parser=None)
+
+    def __project_decoded(self, content_dict):
+        projected = {}
+        for path in self.paths:
+            value = get_in(path, content_dict, default=_MISSING)
+            if value is not _MISSING:
+                _assign_in(projected, path, value)
+                continue
+            for k in range(len(path) - 1, 0, -1):
+                parent = get_in(path[:k], content_dict, default=_MISSING)
+                if parent is _MISSING:
+                    continue
+                if isinstance(parent, (dict, list)):
+                    _assign_in(projected, path[:k], type(parent)(),
+                               replace=False)
+                break
+        return projected
+
+
+_MISSING = object()
+
+
+def _pointer(path):
+    return '/' + '/'.join(str(key) for key in path)
+
+
+def _assign_in(target, path, value, replace=True):
+    """
+    Set ``value`` at ``path`` in ``target``, creating nested dicts and lists
+    on the way. Without ``replace`` a value already at ``path`` is kept.
+
+    >>> target = {}
+    >>> _assign_in(target, ('instance', 0, 'url'), 'u')
+    >>> _assign_in(target, ('instance', 0), {}, replace=False)
+    >>> target
+    {'instance': [{'url': 'u'}]}
+    """
+    for key, next_key in zip(path, path[1:]):
+        child = [] if isinstance(next_key, int) else {}
+        if isinstance(key, int):
+            while len(target) <= key:
+                target.append(type(child)())
+            target = target[key]
+        else:
+            target = target.setdefault(key, child)
+    if isinstance(path[-1], int):
+        while len(target) <= path[-1]:
+            target.append(None)
+        if replace or target[path[-1]] is None:
+            target[path[-1]] = value
+    elif replace or path[-1] not in target:
+        target[path[-1]] = value
+
+
+def main(read_path='path/to/filedataset',
+         store_path='path/to/filedataset_trusts_metadata', sink='jsonl',
+         workers=None, metrics_dir=None, vectorized=False, limit=200):
+    """
+    Transform the OpenAIRE .gz files in ``read_path`` and store the first
+    ``limit`` records, or all with ``limit=None``, below ``store_path``
+    through ``sink``. With ``vectorized`` the records are mapped a
+    DataFrame chunk at a time, see ``openaire_frame_iterable``, in this
+    process only, so it cannot be combined with ``workers``.
+    """
+    if vectorized and workers is not None and workers > 1:
+        raise ValueError("vectorized runs in a single process, "
+                         "workers cannot be used with it")
+    if metrics_dir is not None:
+        metrics.enable()
+    if vectorized:
+        with open_sink(sink, store_path, ensure_ascii=False) as _sink:
+            chunksize = min(limit, 10000) if limit else 10000
+            remaining = limit
+            for frame in openaire_frame_iterable(read_path, chunksize):
+                if remaining is not None:
+                    frame = frame.iloc[:remaining]
+                    remaining -= len(frame)
+                with metrics.timer('store'):
+                    _sink.write_frame(frame, 'resources.remoteId')
+                metrics.count('store', len(frame))
+                if remaining is not None and remaining <= 0:
+                    break
+        if metrics_dir is not None:
+            metrics.write(metrics_dir)
+        return
+    with open_sink(sink, store_path, ensure_ascii=False) as _sink:
+        for json_dict in islice(openaire_file_iterable(read_path, workers),
+                                limit):
+            with metrics.timer('store'):
+                _sink.write(json_dict['resources']['remoteId'], json_dict)
+            metrics.count('store')
+    if metrics_dir is not None:
+        metrics.write(metrics_dir)
+
+
+def openaire_file_iterable(path_to_dataset='.', workers=None,
+                           batch_size=1000, loads=None, projection=True):
     """
     Iterate over the OpenAIRE files (in gzipped format) in the folder
     ``path_to_dataset``, gunzip them, read them line by line and turn each json
-    line into a ``dict``.
+    line into a ``dict``. See ``openaire_batch_iterable`` for the arguments.
+    """
+    for batch in openaire_batch_iterable(path_to_dataset, workers, batch_size,
+                                         loads, projection):
+        yield from batch
+
+
+def openaire_batch_iterable(path_to_dataset='.', workers=None,
+                            batch_size=1000, loads=None, projection=True):
+    """
+    Like ``openaire_file_iterable``, but yield the TRUSTS dicts in lists of up
+    to ``batch_size``. Lines are decoded with ``loads``, by default
+    ``orjson.loads`` if orjson is installed and ``json.loads`` otherwise.
+    With ``projection`` only ``OPENAIRE_REQUIRED_PATHS`` are decoded, see
+    ``ProjectedLoads``.
+
+    With ``workers`` > 1 the .gz files are shared out among as many worker
+    processes, each of which sends back whole batches. A gzip stream can only
+    be read from its start, so a single file is never split between workers
+    and batches of different files arrive in no particular order.
     """
+    loads = loads or JSON_LOADS
+    if projection:
+        loads = ProjectedLoads(OPENAIRE_REQUIRED_PATHS, loads)
+    files = sorted(glob.glob(f"{path_to_dataset}/*.gz"))
+    if workers is None or workers <= 1 or len(files) <= 1:
+        for _gzip in files:
+            yield from __read_batches(_gzip, batch_size, loads)
+    else:
+        yield from __read_batches_parallel(files, min(workers, len(files)),
+                                           batch_size, loads)
 
-    for _gzip in glob.glob(f"{path_to_dataset}/*.gz"):
+
+def openaire_frame_iterable(path_to_dataset='.', chunksize=10000,
+                            loads=None, projection=True):
+    """
+    Like ``openaire_batch_iterable``, but map every chunk of ``chunksize``
+    lines with column operations on a pandas DataFrame instead of record by
+    record. Yields DataFrames of TRUSTS records with dotted columns for the
+    nested keys, e.g. ``resources.url``; they only become dicts at the sink,
+    see ``sinks.Sink.write_frame``. A ``publicationdate`` or ``publisher``
+    that is null gets the same default as a missing one.
+    """
+    # pandas is slow to import and only needed here
+    import pandas as pd
+    loads = loads or JSON_LOADS
+    if projection:
+        loads = ProjectedLoads(OPENAIRE_REQUIRED_PATHS, loads)
+    for _gzip in sorted(glob.glob(f"{path_to_dataset}/*.gz")):
         with gzip.open(_gzip) as f:
-            for line in f:
-                yield toolz.functoolz.pipe(
-                    line, json.loads, __map_openaire_to_trusts,
-                    # __extract_resources,
-                )
+            while True:
+                lines = list(islice(f, chunksize))
+                if not lines:
+                    break
+                with metrics.timer('parse'):
+                    chunk = pd.DataFrame.from_records(
+                        [loads(line) for line in lines],
+                        columns=OPENAIRE_FRAME_COLUMNS)
+                metrics.count('parse', len(lines))
+                with metrics.timer('map'):
+                    frame = __map_openaire_frame(chunk)
+                metrics.count('map', len(frame))
+                yield frame
+
+
+def __map_openaire_frame(frame):
+    """
+    ``__map_openaire_to_trusts`` for a whole DataFrame of OpenAIRE records.
+    """
+    import pandas as pd
+    instance = frame['instance'].str[0]
+    return pd.DataFrame({
+        'name': frame['maintitle'],
+        'title': frame['maintitle'],
+        'notes': frame['description'],
+        'owner_org': 'OpenAIRE',
+        'resources.created':
+            frame['publicationdate'].fillna('None availabe'),
+        'resources.dataProvider':
+            frame['publisher'].fillna('None available'),
+        'resources.remoteId': frame['id'].str.split('::').str[1],
+        'resources.rights': instance.str.get('license'),
+        'resources.url': instance.str.get('url').fillna('None available'),
+        'resources.name': frame['maintitle'],
+    })
+
+
+def __read_batches(_gzip, batch_size, loads):
+    """
+    Read ``_gzip`` and yield its mapped records in lists of ``batch_size``.
+    """
+    with gzip.open(_gzip) as f:
+        while True:
+            lines = list(islice(f, batch_size))
+            if not lines:
+                return
+            with metrics.timer('parse'):
+                content_dicts = [loads(line) for line in lines]
+            metrics.count('parse', len(lines))
+            metrics.add_bytes('parse', sum(len(line) for line in lines))
+            with metrics.timer('map'):
+                batch = [__map_openaire_to_trusts(x) for x in content_dicts]
+            metrics.count('map', len(batch))
+            yield batch
+
+
+def __read_batches_parallel(files, workers, batch_size, loads):
+    """
+    Run ``__batch_worker`` in ``workers`` processes and yield the batches they
+    put on a bounded result queue. The workers are terminated if the consumer
+    stops early.
+    """
+    context = multiprocessing.get_context()
+    tasks = context.Queue()
+    results = context.Queue(maxsize=4 * workers)
+    for _gzip in files:
+        tasks.put(_gzip)
+    for _ in range(workers):
+        tasks.put(None)
+    processes = [context.Process(target=__batch_worker,
+                                 args=(tasks, results, batch_size, loads),
+                                 daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        running = workers
+        while running:
+            kind, payload = results.get()
+            if kind == 'batch':
+                # The workers' own metrics stay in their processes
+                metrics.count('map', len(payload))
+                yield payload
+            elif kind == 'done':
+                running -= 1
+            else:
+                raise RuntimeError(f"OpenAIRE worker failed:\n{payload}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def __batch_worker(tasks, results, batch_size, loads):
+    """
+    Take .gz files from ``tasks`` until a ``None`` arrives and put
+    ``('batch', records)`` for every batch on ``results``, followed by
+    ``('done', None)``, or ``('error', traceback)`` on failure.
+    """
+    try:
+        for _gzip in iter(tasks.get, None):
+            for batch in __read_batches(_gzip, batch_size, loads):
+                results.put(('batch', batch))
+        results.put(('done', None))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
 
 
 def __map_openaire_to_trusts(content_dict):
     """
+    Map a full or projected OpenAIRE record to a TRUSTS data_dict; both give
+    the same result, also for an instance without license and url.
+
+    >>> line = ('{"id": "50|doi::1", "maintitle": "T", "description": "D", '
+    ...         '"instance": [{"type": "Article"}], "author": []}')
+    >>> full = __map_openaire_to_trusts(json.loads(line))
+    >>> full == __map_openaire_to_trusts(ProjectedLoads()(line))
+    True
+    >>> full['resources']['url']
+    'None available'
     """
     return {
         'name': content_dict['maintitle'],
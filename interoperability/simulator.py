@@ -0,0 +1,301 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import rdflib
+
+from rdflib.namespace import OWL, RDF, XSD
+
+
+IDS = rdflib.Namespace("https://w3id.org/idsa/core/")
+ASSET_TYPE = rdflib.URIRef("https://www.trusts-data.eu/ontology/asset_type")
+DATASET = rdflib.URIRef("https://www.trusts-data.eu/ontology/Dataset")
+
+_PAGE = re.compile(r'\s*LIMIT\s+(\d+)\s+OFFSET\s+(\d+)\s*$', re.IGNORECASE)
+
+
+class BrokerSimulator:
+    """
+    Stand-in for a TRUSTS connector and the broker behind it, serving
+    ``api/ids/query`` and ``api/ids/description`` for ``n_resources``
+    generated resources with ``representations`` representations each.
+
+    Queries run with rdflib on an in-memory graph holding what
+    ``clone_experiment.sparl_get_all_resources`` asks for, and are answered
+    in the broker's tab separated format. Descriptions are JSON-LD
+    ``@graph`` documents with ``ids:Resource``, ``ids:Representation`` and
+    ``ids:Artifact`` nodes. Every request waits ``latency`` seconds plus up
+    to ``jitter`` more and fails with a 503 at ``error_rate``; at most
+    ``max_concurrency`` requests are served at a time and the others queue,
+    like on a connector with a fixed worker pool.
+    """
+
+    def __init__(self, n_resources, representations=1, latency=0.0,
+                 jitter=0.0, error_rate=0.0, max_concurrency=None,
+                 host="connector.example.org:8080", seed=0):
+        self.n_resources = n_resources
+        self.representations = representations
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.base = f"https://{host}/api"
+        self._random = random.Random(seed)
+        self._slots = threading.BoundedSemaphore(max_concurrency) \
+            if max_concurrency else None
+        self._graph_lock = threading.Lock()
+        self._results = {}
+        self._requests_lock = threading.Lock()
+        self.graph = self.__build_graph()
+        self.requests = 0
+
+    def __build_graph(self):
+        graph = rdflib.Graph()
+        connector = rdflib.URIRef(f"{self.base}/connector")
+        modified = rdflib.Literal(_timestamp(0), datatype=XSD.dateTimeStamp)
+        for i in range(self.n_resources):
+            resource = rdflib.URIRef(
+                f"https://broker.example.org/resources/{i}")
+            graph.add((resource, RDF.type, IDS.Resource))
+            graph.add((connector, IDS.offeredResource, resource))
+            graph.add((resource, OWL.sameAs, self.offer_uri(i)))
+            graph.add((resource, ASSET_TYPE, DATASET))
+            graph.add((resource, IDS.modified, modified))
+        return graph
+
+    def offer_uri(self, i):
+        return rdflib.URIRef(f"{self.base}/offers/{i}")
+
+    def touch(self, indices, when=None):
+        """
+        Set the ``ids:modified`` of the resources ``indices`` to ``when``, by
+        default now, as if they were updated on the connector.
+        """
+        modified = rdflib.Literal(when or _timestamp(),
+                                  datatype=XSD.dateTimeStamp)
+        with self._graph_lock:
+            for i in indices:
+                resource = rdflib.URIRef(
+                    f"https://broker.example.org/resources/{i}")
+                self.graph.set((resource, IDS.modified, modified))
+            self._results.clear()
+
+    def query(self, query_string):
+        """
+        The tab separated result of a SPARQL SELECT. A trailing
+        ``LIMIT``/``OFFSET`` is applied to the cached full result, so that
+        paging through a large catalogue runs the query only once.
+        """
+        page = _PAGE.search(query_string)
+        if page is not None:
+            query_string = query_string[:page.start()]
+        variables, rows = self.__select(query_string)
+        if page is not None:
+            limit, offset = int(page.group(1)), int(page.group(2))
+            rows = rows[offset:offset + limit]
+        lines = ["\t".join(f"?{x}" for x in variables)]
+        lines += ["\t".join(row) for row in rows]
+        return "\n".join(lines) + "\n"
+
+    def __select(self, query_string):
+        with self._graph_lock:
+            if query_string not in self._results:
+                result = self.graph.query(query_string)
+                variables = [str(x) for x in result.vars]
+                rows = [tuple(x.n3() if x is not None else "" for x in row)
+                        for row in result]
+                if len(self._results) >= 16:
+                    del self._results[next(iter(self._results))]
+                self._results[query_string] = (variables, rows)
+            return self._results[query_string]
+
+    def description(self, element_uri):
+        """
+        The JSON-LD description of the offer ``element_uri``, or ``None`` if
+        there is no such offer.
+        """
+        prefix = f"{self.base}/offers/"
+        if not element_uri.startswith(prefix):
+            return None
+        i = element_uri[len(prefix):]
+        if not i.isdigit() or int(i) >= self.n_resources:
+            return None
+        resource = rdflib.URIRef(f"https://broker.example.org/resources/{i}")
+        with self._graph_lock:
+            modified = str(self.graph.value(resource, IDS.modified))
+        graph = [{
+            "@id": element_uri,
+            "@type": "ids:Resource",
+            "sameAs": element_uri,
+            "title": {"@language": "en", "@value": f"Simulated dataset {i}"},
+            "description": {"@language": "en",
+                            "@value": f"Dataset {i} of the simulator"},
+            "created": _timestamp(0),
+            "modified": modified,
+            "standardLicense": "https://creativecommons.org/licenses/by/4.0/",
+            "asset_type": str(DATASET),
+            "theme": "https://trusts.eu/ontology/themes/Finance",
+            "version": "1",
+        }]
+        for j in range(self.representations):
+            artifact = f"{self.base}/artifacts/{i}-{j}"
+            graph.append({
+                "@id": f"{self.base}/representations/{i}-{j}",
+                "@type": "ids:Representation",
+                "sameAs": f"{self.base}/representations/{i}-{j}",
+                "instance": artifact,
+                "mediaType": "text/csv",
+                "modified": modified,
+            })
+            graph.append({
+                "@id": artifact,
+                "@type": "ids:Artifact",
+                "sameAs": artifact,
+                "checkSum": f"{int(i) * 1000 + j:032x}",
+                "fileName": f"dataset-{i}-{j}.csv",
+                "ids:byteSize": 1024 * (j + 1),
+            })
+        return {"@context": {"ids": str(IDS)}, "@graph": graph}
+
+    def serve(self, host="127.0.0.1", port=8282):
+        """
+        A ``ThreadingHTTPServer`` for this simulator; call its
+        ``serve_forever``, or use ``start``.
+        """
+        simulator = self
+
+        class Handler(_Handler):
+            pass
+        Handler.simulator = simulator
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        Serve in a daemon thread and return the server; its connector URL
+        is ``f"http://{host}:{server.server_port}/"``.
+        """
+        server = self.serve(host, port)
+        threading.Thread(target=server.serve_forever, name='simulator',
+                         daemon=True).start()
+        return server
+
+    def _count_request(self):
+        with self._requests_lock:
+            self.requests += 1
+
+    def _delay_and_fail(self):
+        """
+        Wait the simulated latency; whether this request should fail.
+        """
+        delay = self.latency + self._random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+        return self._random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    simulator = None
+
+    def do_POST(self):
+        simulator = self.simulator
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        slots = simulator._slots
+        if slots is not None:
+            slots.acquire()
+        try:
+            simulator._count_request()
+            if simulator._delay_and_fail():
+                return self.__respond(503, "text/plain", "Simulated error")
+            if url.path.endswith("api/ids/query"):
+                return self.__respond(200, "text/tab-separated-values",
+                                      simulator.query(body.decode("utf-8")))
+            if url.path.endswith("api/ids/description"):
+                description = simulator.description(
+                    params.get("elementId", [""])[0])
+                if description is None:
+                    return self.__respond(404, "text/plain", "Not found")
+                return self.__respond(200, "application/ld+json",
+                                      json.dumps(description))
+            return self.__respond(404, "text/plain", "Not found")
+        except Exception as e:
+            return self.__respond(500, "text/plain", repr(e))
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def __respond(self, status, content_type, text):
+        payload = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _timestamp(days_ago=None):
+    if days_ago is None:
+        when = datetime.now(timezone.utc)
+    else:
+        when = datetime(2022, 2, 2, tzinfo=timezone.utc) - \
+            timedelta(days=days_ago)
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate a TRUSTS connector and its broker.'
+    )
+    parser.add_argument(
+        '-n', '--resources', type=int, default=10000,
+        help='The number of generated resources.'
+    )
+    parser.add_argument(
+        '-r', '--representations', type=int, default=1,
+        help='The number of representations per resource.'
+    )
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='The address to listen on.'
+    )
+    parser.add_argument(
+        '-p', '--port', type=int, default=8282,
+        help='The port to listen on.'
+    )
+    parser.add_argument(
+        '-l', '--latency', type=float, default=0.0,
+        help='Seconds every request waits before it is answered.'
+    )
+    parser.add_argument(
+        '-j', '--jitter', type=float, default=0.0,
+        help='Up to this many more seconds of random extra latency.'
+    )
+    parser.add_argument(
+        '-e', '--error-rate', type=float, default=0.0,
+        help='The fraction of requests answered with a 503.'
+    )
+    parser.add_argument(
+        '-c', '--max-concurrency', type=int,
+        help='The number of requests served at a time; others queue.'
+    )
+    args = parser.parse_args()
+    server = BrokerSimulator(args.resources, args.representations,
+                             args.latency, args.jitter, args.error_rate,
+                             args.max_concurrency).serve(args.host,
+                                                         args.port)
+    print(f"Serving {args.resources} resources on "
+          f"http://{args.host}:{server.server_port}/")
+    server.serve_forever()
@@ -8,9 +8,16 @@ setup(
     author='Stefan Gindl',
     author_email='stefan.gindl@researchstudio.at',
     license='MIT',
-    packages=['interoperability'],
+    packages=['interoperability', 'interoperability.etl'],
+    entry_points={
+        'console_scripts': ['interoperability=interoperability.cli:main'],
+    },
     install_requires=[
         'requests==2.27.1',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.8'],
+        'fastjson': ['orjson>=3.6', 'pysimdjson>=5.0'],
+    },
     zip_safe=False,
 )
@@ -0,0 +1,142 @@
+"""
+Run ``etl.extracting`` against a local pyftpdlib server standing in for the
+Europeana FTP server. Skipped if pyftpdlib is not installed.
+
+    python -m unittest discover tests
+"""
+import ftplib
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'interoperability'))
+
+from etl.extracting import (ChecksumError, download_zips, ftp_login,
+                            list_remote_zips)
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    FTPHandler = None
+
+FTP_DIR = 'dataset/XML'
+
+# Otherwise the server sets up logging of every command to stderr
+logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+
+
+if FTPHandler is not None:
+    class RecordingHandler(FTPHandler):
+        """
+        Keeps the offset of every ``REST`` command the server receives.
+        """
+        rest_offsets = []
+
+        def ftp_REST(self, line):
+            self.rest_offsets.append(int(line))
+            return super().ftp_REST(line)
+
+    class NoMlsdHandler(RecordingHandler):
+        """
+        A server that does not know ``MLSD``, like many older ones.
+        """
+        proto_cmds = {cmd: info for cmd, info in FTPHandler.proto_cmds.items()
+                      if cmd != 'MLSD'}
+
+
+@unittest.skipUnless(FTPHandler is not None, 'needs pyftpdlib')
+class DownloadTest(unittest.TestCase):
+    mlsd = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.to_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(shutil.rmtree, self.to_dir)
+        remote_dir = os.path.join(self.root, FTP_DIR)
+        os.makedirs(remote_dir)
+        self.content = os.urandom(300_000)
+        for fname, md5 in [
+                ('good.zip', hashlib.md5(self.content).hexdigest()),
+                ('corrupt.zip', '0' * 32)]:
+            with open(os.path.join(remote_dir, fname), 'wb') as f:
+                f.write(self.content)
+            with open(os.path.join(remote_dir, f'{fname}.md5sum'), 'w') as f:
+                f.write(f'{md5}  {fname}\n')
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.root)
+        handler = type('Handler',
+                       (RecordingHandler if self.mlsd else NoMlsdHandler,),
+                       {'authorizer': authorizer, 'rest_offsets': []})
+        self.rest_offsets = handler.rest_offsets
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.address[1]
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'timeout': 0.1}, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.close_all)
+
+    def download(self, zips, **kwargs):
+        return download_zips(zips, self.to_dir, '127.0.0.1', n_connections=2,
+                             port=self.port, ftp_dir=FTP_DIR, **kwargs)
+
+    def test_resumes_partial_download_with_rest(self):
+        fpath = os.path.join(self.to_dir, 'good.zip')
+        with open(fpath, 'wb') as f:
+            f.write(self.content[:100_000])
+        self.assertEqual(self.download(['good.zip']), [fpath])
+        self.assertEqual(self.rest_offsets, [100_000])
+        with open(fpath, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_skips_verified_download(self):
+        self.download(['good.zip'])
+        self.download(['good.zip'])
+        self.assertEqual(self.rest_offsets, [])
+
+    def test_rejects_md5_mismatch(self):
+        with self.assertRaises(ChecksumError):
+            self.download(['corrupt.zip'], max_attempts=2)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.to_dir, 'corrupt.zip')))
+
+    def test_lists_zips_and_checksums(self):
+        ftp = ftp_login('127.0.0.1', self.port, FTP_DIR)
+        try:
+            zips, checksums = list_remote_zips(ftp)
+        finally:
+            ftp.quit()
+        self.assertEqual(sorted(zips), ['corrupt.zip', 'good.zip'])
+        self.assertEqual(zips['good.zip'][0], len(self.content))
+        self.assertTrue(zips['good.zip'][1])
+        self.assertEqual(checksums, {'corrupt.zip.md5sum',
+                                     'good.zip.md5sum'})
+
+
+class NlstFallbackTest(DownloadTest):
+    """
+    The tests of ``DownloadTest`` against a server without ``MLSD``.
+    """
+    mlsd = False
+
+    def test_mlsd_is_refused(self):
+        ftp = ftp_login('127.0.0.1', self.port, FTP_DIR)
+        try:
+            with self.assertRaises(ftplib.error_perm):
+                list(ftp.mlsd())
+        finally:
+            ftp.quit()
+
+
+if __name__ == '__main__':
+    unittest.main()